@@ -17,10 +17,16 @@ Contains:
     function fwhm
     function get_distance_list
     function find_local_maxima
+    function local_maxima
     function ultimate_erode
     function gaussian
     functino moments
     function fit_gaussian
+    function fit_gaussians
+    function radial_symmetry_centres
+    function fit_straight_lines
+    function msd_fft
+    function binned_kde
 
 Author:
     Edward Higgins & JWS
@@ -32,7 +38,7 @@ import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy import optimize
+from scipy import ndimage, optimize, signal
 
 from numba import jit
 
@@ -133,15 +139,41 @@ def find_local_maxima(img):
     return local_maxima
 
 
-def ultimate_erode(img, orig):
-    distance_list = np.array(get_distance_list(16))
+def local_maxima(img):
+    """LOCAL_MAXIMA - Vectorised equivalent of find_local_maxima
 
-    img_dist = uer_jittable(img, distance_list)
+    Description:
+        Finds the non-zero pixels that are the maximum of their 3x3
+        neighbourhood, ignoring the outermost rows and columns. The positions
+        are returned as an (N, 2) array of [x, y] in row-major order.
+    """
+    neighbourhood_max = ndimage.maximum_filter(img, size=3)
+    is_max = (img != 0) & (img == neighbourhood_max)
+    is_max[[0, -1], :] = False
+    is_max[:, [0, -1]] = False
+
+    rows, cols = np.nonzero(is_max)
+    return np.column_stack((cols, rows))
+
+
+def ultimate_erode(img, orig, method="EDT"):
+    if method == "EDT":
+        # Distance from each foreground pixel to the nearest background pixel,
+        # treating everything outside the frame as background
+        padded = np.pad(img != 0, 1)
+        img_dist = ndimage.distance_transform_edt(padded)[1:-1, 1:-1]
+
+        spot_locations = local_maxima(img_dist)
+
+    else:
+        distance_list = np.array(get_distance_list(16))
+
+        img_dist = uer_jittable(img, distance_list)
 
-    spot_locations = find_local_maxima(img_dist)
+        spot_locations = find_local_maxima(img_dist)
 
-    if not spot_locations:
-        spot_locations = []
+        if not spot_locations:
+            spot_locations = []
 
     return spot_locations
 
@@ -203,3 +235,320 @@ def fit2Dgaussian(data):
     p, success = optimize.leastsq(errorfunction, params)
     return p, success
 
+
+def fit_gaussians(data, initial=None, max_iter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    """FIT_GAUSSIANS - Fit a 2D Gaussian to each of a stack of images at once
+
+    Description:
+        Fits the same model as fit2Dgaussian, height*exp(-(((x0-x)/wx)**2 +
+        ((y0-y)/wy)**2)/2) with x and y the first and second array indices,
+        to every image in `data` using a batched Levenberg-Marquardt solver
+        with analytic derivatives. Pixels that are NaN are ignored. A fit is
+        flagged as successful when it converges (by ftol or xtol) to finite
+        parameters within max_iter iterations.
+
+    Inputs:
+        np.array([N, rows, cols]): data
+            Images to fit
+
+        np.array([N, 5]): initial
+            Starting (height, x, y, width_x, width_y) for each image. Defaults
+            to a 1000 high, 1.5 wide Gaussian in the centre of the image
+
+    Outputs:
+        np.array([N, 5]): p
+            Fitted (height, x, y, width_x, width_y) for each image, with
+            positive widths
+
+        np.array([N], bool): success
+            Whether each fit converged
+    """
+    num_fits = data.shape[0]
+    x, y = np.indices(data.shape[1:])
+    x = x.ravel().astype(float)
+    y = y.ravel().astype(float)
+
+    values = data.reshape(num_fits, -1)
+    weights = ~np.isnan(values)
+    values = np.where(weights, values, 0)
+
+    if initial is None:
+        p = np.tile(
+            [1000, (data.shape[1] - 1) / 2, (data.shape[2] - 1) / 2, 1.5, 1.5],
+            (num_fits, 1),
+        ).astype(float)
+    else:
+        p = np.array(initial, dtype=float).reshape(num_fits, 5)
+
+    def residuals_and_jacobian(p, fits):
+        height, x0, y0, width_x, width_y = (p[:, i, np.newaxis] for i in range(5))
+        u = (x - x0) / width_x
+        v = (y - y0) / width_y
+        g = np.exp(-(u**2 + v**2) / 2)
+        residuals = (height * g - values[fits]) * weights[fits]
+
+        jacobian = np.empty(residuals.shape + (5,))
+        jacobian[:, :, 0] = g
+        jacobian[:, :, 1] = height * g * u / width_x
+        jacobian[:, :, 2] = height * g * v / width_y
+        jacobian[:, :, 3] = height * g * u**2 / width_x
+        jacobian[:, :, 4] = height * g * v**2 / width_y
+        jacobian *= weights[fits, :, np.newaxis]
+        return residuals, jacobian
+
+    with np.errstate(all="ignore"):
+        residuals, jacobian = residuals_and_jacobian(p, np.arange(num_fits))
+        cost = np.sum(residuals**2, axis=1)
+        damping = np.full(num_fits, 1e-1)
+        success = np.zeros(num_fits, dtype=bool)
+
+        active = np.flatnonzero(np.isfinite(cost))
+        for iteration in range(max_iter):
+            if active.size == 0:
+                break
+
+            # Solve the damped normal equations for every active fit
+            J = jacobian[active]
+            JTJ = np.einsum("nmi,nmj->nij", J, J)
+            JTr = np.einsum("nmi,nm->ni", J, residuals[active])
+            diag = np.diagonal(JTJ, axis1=1, axis2=2)
+            scale = np.maximum(diag, 1e-12 * np.max(diag, axis=1, keepdims=True) + 1e-300)
+            A = JTJ + damping[active, np.newaxis, np.newaxis] * (
+                scale[:, :, np.newaxis] * np.eye(5)
+            )
+            try:
+                step = np.linalg.solve(A, -JTr[:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum("nij,nj->ni", np.linalg.pinv(A), -JTr)
+
+            p_new = p[active] + step
+            new_residuals, new_jacobian = residuals_and_jacobian(p_new, active)
+            new_cost = np.sum(new_residuals**2, axis=1)
+
+            # Accept steps that reduce the cost, otherwise increase the damping
+            improved = np.isfinite(new_cost) & (new_cost < cost[active])
+            accepted = active[improved]
+            p[accepted] = p_new[improved]
+            residuals[accepted] = new_residuals[improved]
+            jacobian[accepted] = new_jacobian[improved]
+            reduction = cost[accepted] - new_cost[improved]
+            cost[accepted] = new_cost[improved]
+            damping[accepted] /= 10
+            damping[active[~improved]] *= 10
+
+            relative_reduction = np.ones(active.size)
+            relative_reduction[improved] = reduction / (cost[accepted] + reduction)
+            step_size = np.linalg.norm(step, axis=1)
+            converged = improved & (
+                (relative_reduction <= ftol)
+                | (step_size <= xtol * (np.linalg.norm(p[active], axis=1) + xtol))
+            )
+            converged |= ~improved & (cost[active] == 0)
+            success[active[converged]] = True
+
+            # Give up on fits the solver can no longer make progress on
+            stalled = damping[active] > 1e16
+            active = active[~(converged | stalled)]
+
+    # The model only depends on the squares of the widths, so the solver can
+    # land on either sign; report them as positive
+    p[:, 3:5] = np.abs(p[:, 3:5])
+
+    success &= np.all(np.isfinite(p), axis=1)
+    return p, success
+
+
+def radial_symmetry_centres(data):
+    """RADIAL_SYMMETRY_CENTRES - Closed-form centres of radially symmetric spots
+
+    Description:
+        Locates the centre of each image in `data` as the point that best
+        fits the lines along the local intensity gradients, following
+        Parthasarathy, Nat. Methods 9, 724 (2012). The estimate is
+        non-iterative, so its cost is fixed regardless of the data.
+
+    Inputs:
+        np.array([N, rows, cols]): data
+            Images containing one spot each
+
+    Outputs:
+        np.array([N, 2]): centres
+            [x, y] (column, row) position of each centre in pixel indices.
+            Centres that cannot be determined are NaN
+    """
+    num_rows, num_cols = data.shape[1:]
+
+    # Midpoints between the pixels, relative to the centre of the image
+    xm = np.arange(num_cols - 1) - (num_cols - 2) / 2
+    ym = np.arange(num_rows - 1) - (num_rows - 2) / 2
+    xm, ym = np.meshgrid(xm, ym)
+
+    # Gradients along the diagonals (Roberts cross), lightly smoothed
+    dIdu = data[:, :-1, 1:] - data[:, 1:, :-1]
+    dIdv = data[:, :-1, :-1] - data[:, 1:, 1:]
+    fdu = ndimage.uniform_filter(dIdu, size=(1, 3, 3), mode="constant")
+    fdv = ndimage.uniform_filter(dIdv, size=(1, 3, 3), mode="constant")
+    dImag2 = fdu**2 + fdv**2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Slope of the gradient line through each midpoint
+        m = -(fdv + fdu) / (fdu - fdv)
+        m = np.where(np.isnan(m), 0, m)
+        finite = np.isfinite(m)
+        m_max = np.max(np.where(finite, np.abs(m), 0), axis=(1, 2), keepdims=True)
+        m = np.where(finite, m, 10 * m_max)
+        b = ym - m * xm
+
+        # Weight by gradient magnitude and distance from the rough centroid
+        sdI2 = np.sum(dImag2, axis=(1, 2))
+        xcentroid = np.sum(dImag2 * xm, axis=(1, 2)) / sdI2
+        ycentroid = np.sum(dImag2 * ym, axis=(1, 2)) / sdI2
+        w = dImag2 / np.sqrt(
+            (xm - xcentroid[:, np.newaxis, np.newaxis]) ** 2
+            + (ym - ycentroid[:, np.newaxis, np.newaxis]) ** 2
+        )
+        wm2p1 = w / (m**2 + 1)
+
+        # Least-squares intersection of all the lines
+        sw = np.sum(wm2p1, axis=(1, 2))
+        smmw = np.sum(m**2 * wm2p1, axis=(1, 2))
+        smw = np.sum(m * wm2p1, axis=(1, 2))
+        smbw = np.sum(m * b * wm2p1, axis=(1, 2))
+        sbw = np.sum(b * wm2p1, axis=(1, 2))
+        det = smw**2 - smmw * sw
+        xc = (smbw * sw - smw * sbw) / det
+        yc = (smbw * smw - smmw * sbw) / det
+
+    centres = np.column_stack((xc + (num_cols - 1) / 2, yc + (num_rows - 1) / 2))
+    centres[~np.isfinite(centres)] = np.nan
+    return centres
+
+
+def fit_straight_lines(x, y, sigma=None):
+    """FIT_STRAIGHT_LINES - Weighted least-squares straight lines through many data sets at once
+
+    Description:
+        Fits y = m*x + c to each data set along the last axis of x and y in
+        closed form, with points weighted by 1/sigma^2 as in curve_fit.
+
+    Returns:
+        m, c: The gradient and intercept of each line, NaN where the data set
+              has fewer than two distinct x values.
+    """
+    x, y = np.broadcast_arrays(x, y)
+    weights = np.ones(y.shape) if sigma is None else np.broadcast_to(1.0 / np.square(sigma), y.shape)
+
+    sum_weights = np.sum(weights, axis=-1)
+    x_mean = np.sum(weights * x, axis=-1) / sum_weights
+    y_mean = np.sum(weights * y, axis=-1) / sum_weights
+    dx = x - x_mean[..., np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m = np.sum(weights * dx * y, axis=-1) / np.sum(weights * dx**2, axis=-1)
+    c = y_mean - m * x_mean
+
+    return m, c
+
+
+def msd_fft(positions):
+    """MSD_FFT - Time-averaged mean squared displacement at every lag
+
+    Description:
+        Computes the MSD of trajectories of L points at lags 0 to L-1 in
+        O(L log L) as MSD(m) = S1(m) - 2*S2(m), where S2 is the positional
+        autocorrelation, found with an FFT, and S1 the mean of the squared
+        distances from the origin of the two points of each pair, found from
+        cumulative sums. Points that are NaN (frames a trajectory has no spot
+        in) are left out of the pairs, in which case every sum over pairs is
+        found as a correlation with an FFT.
+
+    Parameters:
+        positions: Array of shape (..., L, D) of trajectory positions.
+
+    Returns:
+        msd:       Array of shape (..., L), the MSD at each lag, NaN at lags
+                   with no pairs.
+        num_pairs: Array of shape (..., L), the number of pairs averaged at
+                   each lag.
+    """
+    length = positions.shape[-2]
+    valid = ~np.any(np.isnan(positions), axis=-1)
+    # The MSD does not depend on the origin, centring avoids cancellation
+    positions = positions - np.nanmean(positions, axis=-2, keepdims=True)
+
+    def correlate(a, b):
+        # sum_i a[i] b[i + m] along the last axis, for every lag m
+        transform = np.fft.rfft(a, n=2 * length, axis=-1).conj()
+        transform *= np.fft.rfft(b, n=2 * length, axis=-1)
+        return np.fft.irfft(transform, n=2 * length, axis=-1)[..., :length]
+
+    if np.all(valid):
+        num_pairs = np.broadcast_to(length - np.arange(length), valid.shape)
+
+        transform = np.fft.rfft(positions, n=2 * length, axis=-2)
+        autocorrelation = np.fft.irfft(transform * transform.conj(), n=2 * length, axis=-2)
+        s2 = np.sum(autocorrelation[..., :length, :], axis=-1) / num_pairs
+
+        sq_dist = np.sum(positions**2, axis=-1)
+        leading = np.cumsum(sq_dist, axis=-1) - sq_dist
+        trailing = np.cumsum(sq_dist[..., ::-1], axis=-1) - sq_dist[..., ::-1]
+        s1 = (2 * np.sum(sq_dist, axis=-1, keepdims=True) - leading - trailing) / num_pairs
+
+        return s1 - 2 * s2, num_pairs
+
+    weights = valid.astype(float)
+    positions = np.where(valid[..., np.newaxis], positions, 0)
+    sq_dist = np.sum(positions**2, axis=-1)
+    num_pairs = np.rint(correlate(weights, weights)).astype(int)
+
+    s1 = correlate(weights, sq_dist) + correlate(sq_dist, weights)
+    s2 = sum(correlate(positions[..., d], positions[..., d]) for d in range(positions.shape[-1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        msd = np.where(num_pairs > 0, (s1 - 2 * s2) / num_pairs, np.nan)
+
+    return msd, num_pairs
+
+
+def binned_kde(data, grid, bw_factor):
+    """BINNED_KDE - Gaussian kernel density estimate on an evenly spaced grid
+
+    Description:
+        Estimates the same density as
+        scipy.stats.gaussian_kde(data, bw_method=bw_factor).evaluate(grid),
+        with a kernel width of bw_factor times the standard deviation of the
+        data. The data are linearly binned onto a grid fine enough compared to
+        the kernel width, and convolved with the kernel by FFT, so the cost is
+        close to linear in the number of data and grid points.
+
+    Returns:
+        pdf: The density at each grid point.
+    """
+    data = np.ravel(data).astype(float)
+    grid = np.asarray(grid, dtype=float)
+    sigma = bw_factor * np.std(data, ddof=1)
+    norm = len(data) * sigma * np.sqrt(2 * np.pi)
+
+    if len(grid) < 2:
+        return np.sum(np.exp(-0.5 * ((grid[:, np.newaxis] - data) / sigma) ** 2), axis=1) / norm
+
+    # Subdivide the grid until the bins are at most a tenth of the kernel width
+    subdivisions = max(1, int(np.ceil(10 * (grid[1] - grid[0]) / sigma)))
+    step = (grid[1] - grid[0]) / subdivisions
+    num_grid = (len(grid) - 1) * subdivisions + 1
+
+    # Linearly bin the data onto the fine grid, extended to hold all the data
+    first = min(int(np.floor((data.min() - grid[0]) / step)), 0)
+    last = max(int(np.ceil((data.max() - grid[0]) / step)), num_grid - 1)
+    position = (data - grid[0]) / step - first
+    left = np.floor(position).astype(int)
+    fraction = position - left
+    counts = (
+        np.bincount(left, 1 - fraction, minlength=last - first + 2)
+        + np.bincount(left + 1, fraction, minlength=last - first + 2)
+    )[: last - first + 1]
+
+    reach = int(np.ceil(5 * sigma / step))
+    offsets = np.arange(-reach, reach + 1) * step
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2) / norm
+    density = signal.fftconvolve(counts, kernel, mode="same")
+
+    return density[-first : -first + num_grid : subdivisions]
@@ -20,7 +20,7 @@ import numpy as np
 
 from dash_ui.app import app
 from parameters import Parameters
-from trajectories import read_trajectories
+from trajectories import read_trajectories, trajectory_filename
 import images
 
 render_options = [
@@ -73,11 +73,11 @@ def update_slider(render_selection, vis_frame, active_file):
             image_data.pixel_data[vis_frame-1,:,:],
             color_continuous_scale='gray',
             zmin = 0,
-            zmax = np.max(image_data.pixel_data[:,:,:]),
+            zmax = image_data.max_intensity(),
         )
         if (render_selection == "render-all-trajectories" or
             render_selection == "render-current-trajectories"):
-            trajs = read_trajectories(params.name + "_trajectories.tsv")
+            trajs = read_trajectories(trajectory_filename(params.name + "_trajectories", params))
             colors = px.colors.qualitative.Plotly
             if trajs:
                 for traj in trajs:
@@ -87,9 +87,9 @@ def update_slider(render_selection, vis_frame, active_file):
                     Xs = []
                     Ys = []
                     color = colors[traj.id % len(colors)]
-                    for frame in range(traj.start_frame, traj.end_frame):
-                        Xs.append(traj.path[frame - traj.start_frame][0])
-                        Ys.append(traj.path[frame - traj.start_frame][1])
+                    for position in traj.path:
+                        Xs.append(position[0])
+                        Ys.append(position[1])
                     fig.add_trace(go.Scatter(x=Xs, y=Ys, marker=dict(color=color, size=5)))
                     fig.update_layout(showlegend=False)
 
@@ -88,10 +88,11 @@ def update_info(filename, frame_num):
     avg_stoich = 0.0
     for traj in trajs:
         intensities.extend([x for x in  traj.intensity])
-        if frame_num >= traj.start_frame and frame_num <= traj.end_frame:
+        i = traj.frame_index(frame_num)
+        if i is not None:
             num_spots += 1
-            avg_intensity += traj.intensity[frame_num - traj.start_frame]
-            avg_snr     += traj.snr[frame_num - traj.start_frame]
+            avg_intensity += traj.intensity[i]
+            avg_snr     += traj.snr[i]
             avg_stoich  += traj.stoichiometry
 
     if num_spots > 0:
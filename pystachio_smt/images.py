@@ -14,6 +14,10 @@ Description:
 
 Contains:
     class    ImageData
+    class    ImageFrame
+    class    TiffStack
+    function open_stack
+    function split_alex
     function display_image
 
 Author:
@@ -32,35 +36,173 @@ import numpy as np
 import tifffile
 
 
+class TiffStack:
+    """TIFFSTACK - Lazily decoded stack of TIFF pages
+
+    Description:
+        TiffStack behaves like a read-only (frames, rows, columns) array, but
+        only decodes the pages that are actually indexed. Slicing along the
+        frame axis returns another TiffStack, so windows of a stack can be
+        taken without reading any pixel data. It is used for TIFFs that cannot
+        be memory-mapped (e.g. compressed stacks).
+    """
+
+    def __init__(self, filename):
+        self._tiff = tifffile.TiffFile(filename)
+        self._pages = self._tiff.series[0].pages
+        self.dtype = self._pages[0].dtype
+        self._frames = range(len(self._pages))
+        self._rows = range(self._pages[0].shape[0])
+        self._cols = range(self._pages[0].shape[1])
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        frames, rows, cols = (
+            axis[k] for axis, k in zip((self._frames, self._rows, self._cols), key)
+        )
+
+        if isinstance(frames, range):
+            view = object.__new__(TiffStack)
+            view._tiff = self._tiff
+            view._pages = self._pages
+            view.dtype = self.dtype
+            view._frames, view._rows, view._cols = frames, rows, cols
+            return view
+
+        return self._read(frames, rows, cols)
+
+    def __array__(self, dtype=None, copy=None):
+        pixel_data = np.empty(self.shape, dtype=self.dtype)
+        for i, frame in enumerate(self._frames):
+            pixel_data[i] = self._read(frame, self._rows, self._cols)
+
+        if dtype is not None:
+            pixel_data = pixel_data.astype(dtype, copy=False)
+        return pixel_data
+
+    @property
+    def shape(self):
+        return (len(self._frames),) + tuple(
+            len(axis) for axis in (self._rows, self._cols) if isinstance(axis, range)
+        )
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _read(self, frame, rows, cols):
+        page = self._pages[frame].asarray()
+        return page[_as_index(rows), _as_index(cols)]
+
+
+def _as_index(axis):
+    # Convert a range (as produced by slicing a range) back into a slice
+    if isinstance(axis, range):
+        return slice(axis.start, axis.stop if axis.stop >= 0 else None, axis.step)
+    return axis
+
+
+def open_stack(filename):
+    """OPEN_STACK - Open a TIFF stack without reading it into memory
+
+    Description:
+        Uncompressed, contiguous TIFFs are memory-mapped so that frames are
+        paged in by the OS as they are accessed. Anything else is wrapped in a
+        TiffStack, which decodes individual pages on demand. Either way the
+        result can be indexed like a (frames, rows, columns) numpy array.
+    """
+    try:
+        pixel_data = tifffile.memmap(filename, mode="r")
+    except ValueError:
+        pixel_data = TiffStack(filename)
+        if len(pixel_data) == 1 and len(pixel_data._tiff.series[0].shape) > 2:
+            # Frames are not stored as separate pages, so read it all at once
+            pixel_data = tifffile.imread(filename)
+
+    if pixel_data.ndim == 2:
+        pixel_data = pixel_data[np.newaxis, :, :]
+
+    return pixel_data
+
+
+class ImageFrame:
+    """IMAGEFRAME - Lightweight view of a single frame of an ImageData stack
+
+    Description:
+        ImageFrame exposes the same attributes as a single-frame ImageData,
+        but its pixel_data is a view onto the parent stack in the stack's own
+        dtype rather than a copy. Spot refinement and measurement work on
+        pixel_data directly, so a float32 stack is measured in float32. The
+        uint16 image returned by as_image is only used for the candidate
+        search; it is computed once and cached, so it must be treated as
+        read-only.
+    """
+
+    __slots__ = (
+        "pixel_data", "frame_size", "num_frames", "num_pixels",
+        "has_mask", "mask_data", "exists", "_image",
+    )
+
+    def __init__(self, pixel_data, frame_size, has_mask=False, mask_data=None):
+        self.pixel_data = pixel_data
+        self.frame_size = frame_size
+        self.num_frames = 1
+        self.num_pixels = frame_size[0] * frame_size[1]
+        self.has_mask = has_mask
+        self.mask_data = mask_data
+        self.exists = True
+        self._image = None
+
+    def as_image(self, frame=0, drop_dim=True):
+        if self._image is None:
+            self._image = self.pixel_data[0, :, :].astype(np.uint16, copy=False)
+
+        if drop_dim:
+            return self._image
+        return self._image[np.newaxis, :, :]
+
+
 class ImageData:
     def __init__(self):
         self.num_frames = -1
         self.has_mask = False
         self.pixel_data = None
         self.mask_data = None
+        self.dtype = None
         self.exists = False
 
     def __getitem__(self, index):
-        frame = ImageData()
-        frame.initialise(1, self.frame_size)
-        frame.pixel_data[0, :, :] = self.pixel_data[index, :, :]
-        frame.mask_data = self.mask_data
-        frame.has_mask = self.has_mask
-        return frame
+        frame_data = self.pixel_data[index, :, :][np.newaxis, :, :]
+        if self.dtype is not None:
+            frame_data = frame_data.astype(self.dtype, copy=False)
+
+        return ImageFrame(
+            frame_data,
+            self.frame_size,
+            self.has_mask,
+            self.mask_data,
+        )
 
     def __setitem__(self, index, value):
-        if value.__class__ == "ImageData":
+        if isinstance(value, (ImageData, ImageFrame)):
             self.pixel_data[index, :, :] = value.pixel_data[0, :, :]
         else:
             self.pixel_data[index, :, :] = value
 
-    def initialise(self, num_frames, frame_size):
+    def initialise(self, num_frames, frame_size, dtype=np.uint16):
         self.num_frames = num_frames
         self.frame_size = frame_size
         self.num_pixels = frame_size[0] * frame_size[1]
 
-        self.pixel_data = np.zeros([num_frames, frame_size[1], frame_size[0]])
-        self.mask_data = np.zeros([num_frames, frame_size[1], frame_size[0]])
+        # Pixels are stored in the camera's dtype, the mask only exists once read
+        self.dtype = np.dtype(dtype)
+        self.pixel_data = np.zeros([num_frames, frame_size[1], frame_size[0]], dtype=dtype)
+        self.mask_data = None
         self.has_mask = False
 
         self.exists = True
@@ -68,9 +210,9 @@ class ImageData:
     def as_image(self, frame=0, drop_dim=True):
 
         if drop_dim:
-            img = self.pixel_data.astype(np.uint16)[frame, :, :]
+            img = self.pixel_data[frame, :, :].astype(np.uint16)
         else:
-            img = self.pixel_data.astype(np.uint16)
+            img = np.asarray(self.pixel_data).astype(np.uint16)
         return img
 
     def read(self, filename, params):
@@ -78,22 +220,23 @@ class ImageData:
         if not os.path.isfile(filename):
             sys.exit(f"Unable to find file matching '{filename}'")
 
-        # Read in the file and get the data size
-        pixel_data = tifffile.imread(filename)
+        # Open the file and get the data size, frames are only read on access
+        pixel_data = open_stack(filename)
 
         if params.cell_mask:
             if os.path.isfile(params.cell_mask):
                 pixel_mask = tifffile.imread(params.cell_mask)
-                pixel_mask = np.where(pixel_mask > 0, 1, 0)
+                pixel_mask = (pixel_mask > 0).astype(np.uint8)
                 self.has_mask = True
                 self.mask_data = pixel_mask
         else:
             self.use_mask = False
 
+        start_frame = min(params.start_frame, pixel_data.shape[0])
         if params.num_frames:
-            self.num_frames = min(params.num_frames, pixel_data.shape[0])
+            self.num_frames = min(params.num_frames, pixel_data.shape[0] - start_frame)
         else:
-            self.num_frames = pixel_data.shape[0]
+            self.num_frames = pixel_data.shape[0] - start_frame
 
         if params.channel_split == "Vertical":
             self.frame_size = (pixel_data.shape[2]//2, pixel_data.shape[1])
@@ -104,8 +247,18 @@ class ImageData:
 
         self.num_pixels = self.frame_size[0] * self.frame_size[1]
 
-        # Store the frames in a list
-        self.pixel_data = pixel_data[:self.num_frames, :self.frame_size[1], :self.frame_size[0]]
+        # Frames keep the acquisition dtype unless float32 processing is requested
+        if params.pixel_dtype == "float32":
+            self.dtype = np.dtype(np.float32)
+        else:
+            self.dtype = pixel_data.dtype
+
+        # Keep a (lazy) view of the frames being analysed
+        self.pixel_data = pixel_data[
+            start_frame : start_frame + self.num_frames,
+            : self.frame_size[1],
+            : self.frame_size[0],
+        ]
 
         self.determine_first_frame()
 
@@ -129,6 +282,58 @@ class ImageData:
         self.first_frame = 0
 
     def max_intensity(self):
-        max_intensity = np.max(self.pixel_data)
+        # Work frame by frame so that lazily-read stacks are never fully loaded
+        max_intensity = max(
+            np.max(self.pixel_data[frame, :, :]) for frame in range(self.num_frames)
+        )
 
         return max_intensity
+
+
+def split_alex(image_data, start_channel="L"):
+    """SPLIT_ALEX - Split an ALEX stack into its left and right channels
+
+    Description:
+        In alternating-laser (ALEX) stacks, even frames hold one channel in
+        their left half and odd frames hold the other in their right half.
+        start_channel says which of the two is the left channel. Each channel
+        is returned as an ImageData whose pixel_data is a strided view onto
+        the original stack, so no pixel data is copied (or, for lazily read
+        stacks, read) until a frame is accessed.
+
+    Inputs:
+        ImageData: image_data
+            The interleaved stack
+
+        str: start_channel
+            'L' if the even frames are the left channel
+
+    Outputs:
+        ImageData: left
+            The left channel
+
+        ImageData: right
+            The right channel
+    """
+    num_frames = image_data.num_frames // 2
+    half_width = image_data.frame_size[0] // 2
+
+    channels = []
+    for first, columns in ((0, slice(0, half_width)), (1, slice(half_width, 2 * half_width))):
+        channel = ImageData()
+        channel.num_frames = num_frames
+        channel.frame_size = (half_width, image_data.frame_size[1])
+        channel.num_pixels = channel.frame_size[0] * channel.frame_size[1]
+        channel.pixel_data = image_data.pixel_data[first : 2 * num_frames : 2, :, columns]
+        channel.dtype = image_data.dtype
+        channel.has_mask = image_data.has_mask
+        if image_data.has_mask:
+            channel.mask_data = image_data.mask_data[:, columns]
+        channel.first_frame = 0
+        channel.exists = True
+        channels.append(channel)
+
+    if start_channel == "L":
+        return channels[0], channels[1]
+    else:
+        return channels[1], channels[0]
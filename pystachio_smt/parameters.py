@@ -96,6 +96,12 @@ default_parameters = {
           'level': 'advanced',
           'class': 'image',
           'default': ''},
+    'pixel_dtype':
+        { 'description': 'Data type of the pixels used for spot refinement and measurement (Native keeps the file dtype)',
+          'level': 'advanced',
+          'class': 'image',
+          'default': 'Native',
+          'options': ['Native', 'float32'] },
     'ALEX':
         { 'description': 'Perform Alternating-Laser experiment analysis',
           'level': 'basic',
@@ -176,6 +182,12 @@ default_parameters = {
           'class': 'tracking',
           'default': 'Gaussian',
           'options': ['Gaussian', 'None']},
+    'erosion_method':
+        { 'description': 'Method for ultimate erosion of the b/w image (EDT is an exact distance transform, Lookup caps distances at 16px)',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 'EDT',
+          'options': ['EDT', 'Lookup']},
     'max_displacement':
         { 'description': 'Maximum displacement allowed for spots between frames',
           'level': 'advanced',
@@ -186,6 +198,23 @@ default_parameters = {
           'level': 'advanced',
           'class': 'tracking',
           'default': 5 },
+    'trajectory_format':
+        { 'description': 'File format for the tracked trajectories (TSV text or NPZ binary columns with a frame index)',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 'TSV',
+          'options': ['TSV', 'NPZ']},
+    'linking_method':
+        { 'description': 'Method for linking spots into trajectories (Greedy nearest candidate or global linear assignment, LAP)',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 'Greedy',
+          'options': ['Greedy', 'LAP']},
+    'max_gap_frames':
+        { 'description': 'Maximum number of missing frames that can be bridged within a trajectory',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 0 },
     'min_traj_len':
         { 'description': 'Minimum number of frames needed to define a trajectory',
           'level': 'advanced',
@@ -196,6 +225,12 @@ default_parameters = {
           'level': 'advanced',
           'class': 'tracking',
           'default': 8 },
+    'refinement_method':
+        { 'description': 'Method for refining spot centres (Iterative Gaussian masking or closed-form Radial symmetry)',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 'Iterative',
+          'options': ['Iterative', 'Radial']},
     'gauss_mask_sigma':
         { 'description': 'Width of the Gaussian used for the iterative centre refinement',
           'level': 'advanced',
@@ -206,6 +241,21 @@ default_parameters = {
           'level': 'advanced',
           'class': 'tracking',
           'default': 1000 },
+    'streaming':
+        { 'description': 'Link and write trajectories while frames are still being tracked',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': False },
+    'stream_window':
+        { 'description': 'Maximum number of frames being detected at once when running in parallel',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 64 },
+    'frame_chunk_size':
+        { 'description': 'Number of frames detected together as a block (and handed to a worker at a time)',
+          'level': 'advanced',
+          'class': 'tracking',
+          'default': 8 },
     'inner_mask_radius':
         { 'description': 'Radius of the mask used for calculating spot intensities',
           'level': 'advanced',
@@ -233,6 +283,11 @@ default_parameters = {
           'level': 'basic',
           'class': 'postprocessing',
           'default': 4 },
+    'full_msd':
+        { 'description': 'Flag to specify whether to also write the ensemble time-averaged MSD at every lag',
+          'level': 'advanced',
+          'class': 'postprocessing',
+          'default': False},
     'stoic_method':
         { 'description': 'Method used for determining the stoichiometry of each trajectory',
           'level': 'advanced',
@@ -8,11 +8,11 @@ v0.1 Jack W Shepherd, University of York
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import curve_fit
-from scipy.stats import gaussian_kde
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.spatial import distance_matrix
 import os
 import trajectories, images
+from algorithms import binned_kde, fit_straight_lines, msd_fft
 
 display_figures = False
 
@@ -23,7 +23,9 @@ def postprocess(params, simulated=False):
         if False: #simulated:
             trajs = trajectories.read_trajectories(params.name + "_simulated_trajectories.tsv")
         else:
-            trajs = trajectories.read_trajectories(params.name + "_trajectories.tsv")
+            trajs = trajectories.read_trajectories(
+                trajectories.trajectory_filename(params.name + "_trajectories", params)
+            )
         spots = trajectories.to_spots(trajs)
         if params.verbose:
             print(f"Looking at {len(trajs)} trajectories across {len(spots)} frames")
@@ -51,14 +53,18 @@ def postprocess(params, simulated=False):
                 print(f"Tracked diffusion coefficient: {np.mean(dc)}")
             #print(f"Tracked Isingle:               {calculated_isingle[0]}")
 
-        plot_traj_intensities(params, trajs, params.chung_kennedy)
+        plot_traj_intensities(params, trajs, chung_kennedy=params.chung_kennedy)
         get_stoichiometries(trajs, calculated_isingle, params)
         if params.copy_number==True: get_copy_number(params, calculated_isingle)
 
     elif params.ALEX:
 
-        Rtrajs = trajectories.read_trajectories(params.name + "_Rchannel_trajectories.tsv")
-        Ltrajs = trajectories.read_trajectories(params.name + "_Lchannel_trajectories.tsv")
+        Rtrajs = trajectories.read_trajectories(
+            trajectories.trajectory_filename(params.name + "_Rchannel_trajectories", params)
+        )
+        Ltrajs = trajectories.read_trajectories(
+            trajectories.trajectory_filename(params.name + "_Lchannel_trajectories", params)
+        )
         Rspots = trajectories.to_spots(Rtrajs)
         Lspots = trajectories.to_spots(Ltrajs)
 
@@ -87,8 +93,8 @@ def postprocess(params, simulated=False):
         R_calculated_snr = plot_snr(params,Rsnrs, channel="R")
         Ldc, Llp = get_diffusion_coef(Ltrajs, params, channel="L")
         Rdc, Rlp = get_diffusion_coef(Rtrajs, params, channel="R")
-        plot_traj_intensities(params, Ltrajs, channel="L")
-        plot_traj_intensities(params, Rtrajs, channel="R")
+        plot_traj_intensities(params, Ltrajs, channel="L", chung_kennedy=params.chung_kennedy)
+        plot_traj_intensities(params, Rtrajs, channel="R", chung_kennedy=params.chung_kennedy)
         get_stoichiometries(Ltrajs, L_isingle, params, channel="L")
         get_stoichiometries(Rtrajs, R_isingle, params, channel="R")
         
@@ -105,64 +111,38 @@ def chung_kennedy_filter(data, window, R): #God only knows
     # Originally based on some old Fortran written in 2000
     # A good Fortran programmer can write Fortran in any language....
     # ... Even 21 years later!
-    N = len(data)
-    extended_data = np.zeros(N+2*window)
-    extended_data[window:-window]=data
-    for i in range(1,window+1):
-        extended_data[window-i] = data[i-1]
-        extended_data[N+window+i-1] = data[N-i]  
-    N_extended = extended_data.shape[0]
-    wdiffx = np.zeros(N_extended)
-    datamx = np.zeros((N+window,window))
-    datx = np.zeros((N+window+1,window))
-    for i in range(window):
-        stop = N+window+i
-        datamx[:,i] = extended_data[i:stop]
-    wx = np.mean(datamx,axis=1)
-    sx = np.std(datamx,axis=1,ddof=1)
-    XP = wx[:N_extended]
-    XM = wx[window+1:N_extended+window+1]
-    SDP = sx[:N]
-    SDM = sx[window:N_extended+window]
-    DSD = SDP-SDM
-    SP = SDP**2
-    SM = SDM**2
-    
+    # Filters all the traces along the last axis of data at once, giving
+    # filtered traces one point shorter than the input. Traces must be at
+    # least window points long.
+    N = data.shape[-1]
+    # Pad each end with the first/last window points, mirrored
+    extended_data = np.concatenate(
+        [data[..., :window][..., ::-1], data, data[..., ::-1][..., :window]], axis=-1
+    )
+    windows = sliding_window_view(extended_data, window, axis=-1)
+    wx = np.mean(windows, axis=-1)
+    sx = np.std(windows, axis=-1, ddof=1)
+    XP = wx[..., :N-1]
+    XM = wx[..., window+1:window+N]
+    SP = sx[..., :N-1]**2
+    SM = sx[..., window:window+N-1]**2
+
     # Form switching functions (?)
     RSP = SP**R
     RSM = SM**R
-    GM = RSP/(RSP+RSM)
-    GP = RSM/(RSP+RSM)
-
-    S = np.zeros(GP.shape)
-    XX = np.zeros(GP.shape)
-    for i in range(len(GP)-1):
-        if GM[i]>=0 and GM[i]<=1 and GP[i]>=0 and GP[i]<=1:
-            S[i] = GM[i]*SM[i] + GP[i]*SP[i]
-            XX[i] = GP[i]*XP[i] + GM[i]*XM[i]
-        else:
-            S[i] =  SP[i]
-            XX[i] = XP[i]
-    # SD = np.sqrt(S)
-    # SE = np.sqrt(S/window)
-    # TX = (XP-XM)/(np.sqrt(2.)*SE);
-    # DX = (XP-XM)
-    # XPRE = XP
-    return [XX] #[XX,TX,DX,SD,DSD,XPRE]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        GM = RSP/(RSP+RSM)
+        GP = RSM/(RSP+RSM)
+
+    # Fall back on the forward mean where the switching functions are not
+    # weights
+    valid = (GM >= 0) & (GM <= 1) & (GP >= 0) & (GP <= 1)
+    return np.where(valid, GP*XP + GM*XM, XP)
 
 def colocalize(params, Ltrajs, Rtrajs):
     image_data = images.ImageData()
     image_data.read(params.name + '.tif', params)
-    imageL=np.zeros((image_data.num_frames//2,image_data.frame_size[1],image_data.frame_size[0]//2))
-    imageR=np.zeros((image_data.num_frames//2,image_data.frame_size[1],image_data.frame_size[0]//2))
-    if params.start_channel=='L':
-        for i in range(0,image_data.num_frames-1,2):
-            imageL[i//2,:,:] = image_data.pixel_data[i,:,:image_data.frame_size[0]//2]
-            imageR[i//2,:,:] = image_data.pixel_data[i+1,:,image_data.frame_size[0]//2:]
-    else:
-        for i in range(0,image_data.num_frames-1,2):
-            imageR[i//2,:,:] = image_data.pixel_data[i,:,:image_data.frame_size[0]//2]
-            imageL[i//2,:,:] = image_data.pixel_data[i+1,:,image_data.frame_size[0]//2:]
+    imageL, imageR = images.split_alex(image_data, params.start_channel)
     Llinks = []
     Rlinks = []
     nlinks = []
@@ -170,11 +150,13 @@ def colocalize(params, Ltrajs, Rtrajs):
         s1 = []
         s2 = []
         for traj in Ltrajs:
-            if traj.start_frame<=i and traj.end_frame>=i:
-                s1.append([traj.path[i-traj.start_frame],traj.width,traj.id])
+            row = traj.frame_index(i)
+            if row is not None:
+                s1.append([traj.path[row],traj.width,traj.id])
         for traj in Rtrajs:
-            if traj.start_frame<=i and traj.end_frame>=i:
-                s2.append([traj.path[i-traj.start_frame],traj.width,traj.id])
+            row = traj.frame_index(i)
+            if row is not None:
+                s2.append([traj.path[row],traj.width,traj.id])
         id1, id2 = linker(params,s1,s2)
         for j in range(len(id1)):
             found = False
@@ -199,10 +181,10 @@ def colocalize(params, Ltrajs, Rtrajs):
                         
     colors = ['r','b','g','m','y','c']
     c = 0
-    z, y, x = imageL.shape
+    z, y, x = imageL.pixel_data.shape
     disp_frame = np.zeros((y,2*x))
-    disp_frame[:,:x] = imageL[1,:,:]
-    disp_frame[:,x:] = imageR[1,:,:]
+    disp_frame[:,:x] = imageL.pixel_data[1,:,:]
+    disp_frame[:,x:] = imageR.pixel_data[1,:,:]
     plt.imshow(disp_frame, cmap="Greys_r")
     plt.plot([x,x],[0,x], 'w--')
     plt.xticks([])
@@ -285,9 +267,8 @@ def get_copy_number(params, calculated_isingle, channel=None):
 
 def plot_snr(params,snr,channel=None):
     bandwidth=0.07
-    kde = gaussian_kde(snr[snr != 0], bw_method=bandwidth)
     x = np.linspace(0, np.amax(snr), 10000)
-    pdf = kde.evaluate(x)
+    pdf = binned_kde(snr[snr != 0], x, bandwidth)
     fig, ax1 = plt.subplots()
     ax1.hist(snr[snr != 0], bins=np.arange(0,np.amax(snr)+2,0.05), label="Raw data")
     ax2 = ax1.twinx()
@@ -320,9 +301,8 @@ def get_isingle(params, intensities, channel=None):
     scale = 3
     intensities = intensities[intensities > 1]
     bandwidth = 0.1
-    kde = gaussian_kde(intensities, bw_method=bandwidth)
     x = np.linspace(0, np.amax(intensities), int(np.amax(intensities)))
-    pdf = kde.evaluate(x)
+    pdf = binned_kde(intensities, x, bandwidth)
     peak = x[np.where(pdf == np.amax(pdf))].astype('int')
     peakval = np.amax(pdf)
     fig, ax1 = plt.subplots()
@@ -362,48 +342,85 @@ def get_isingle(params, intensities, channel=None):
     return peak
 
 
+def get_msds(trajs, params):
+    # Mean squared displacements for the first msd_num_points lags of every
+    # trajectory long enough to have them, computed for all the trajectories
+    # spanning the same number of frames together. Lags are in frames, so
+    # pairs of points are only taken across the frames a trajectory has spots
+    # in. Also gives the relative number of displacements averaged at each
+    # lag, which is used as the sigma of the fits.
+    num_points = params.msd_num_points
+    used = np.flatnonzero(trajs.lengths >= num_points + 1)
+    spans = trajs.spans[used]
+    lags = np.arange(1, num_points + 1)
+
+    msds = np.zeros((len(used), num_points))
+    num_pairs = np.zeros((len(used), num_points), dtype=int)
+    for span in np.unique(spans):
+        group = np.flatnonzero(spans == span)
+        positions = trajs.frame_grid(trajs.positions, used[group]) * params.pixel_size
+        for lag in lags:
+            sqd = np.sum((positions[:, lag:] - positions[:, :-lag]) ** 2, axis=2)
+            paired = ~np.isnan(sqd)
+            num_pairs[group, lag - 1] = np.sum(paired, axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                msds[group, lag - 1] = (
+                    np.sum(np.where(paired, sqd, 0), axis=1) / num_pairs[group, lag - 1]
+                )
+
+    # Gaps can leave a trajectory with no displacements at some lags
+    complete = np.all(num_pairs > 0, axis=1)
+    msds = msds[complete]
+    num_pairs = num_pairs[complete]
+
+    tau = lags * params.frame_time
+    weights = num_pairs.astype("float32") / num_pairs[:, :1]
+
+    return tau, msds, weights
+
+def write_ensemble_msd(trajs, params, channel=None):
+    # Time-averaged MSD at every lag (in frames) pooled over all the
+    # trajectories, with each trajectory's MSD weighted by the number of
+    # displacements behind it
+    max_span = trajs.spans.max(initial=1)
+    total_sqd = np.zeros(max_span)
+    num_displacements = np.zeros(max_span, dtype=int)
+    for span in np.unique(trajs.spans):
+        group = np.flatnonzero(trajs.spans == span)
+        msds, pairs = msd_fft(trajs.frame_grid(trajs.positions, group) * params.pixel_size)
+        total_sqd[:span] += np.sum(np.where(pairs > 0, msds * pairs, 0), axis=0)
+        num_displacements[:span] += np.sum(pairs, axis=0)
+
+    if channel=="L":
+        ofile = params.name+"_Lchannel_ensemble_msd.tsv"
+    elif channel=="R":
+        ofile = params.name+"_Rchannel_ensemble_msd.tsv"
+    else:
+        ofile = params.name+"_ensemble_msd.tsv"
+    f = open(ofile, "w")
+    f.write("tau\tMSD\tnum_displacements\n")
+    for lag in np.flatnonzero(num_displacements[1:]) + 1:
+        f.write(f"{lag * params.frame_time}\t{total_sqd[lag] / num_displacements[lag]}\t{num_displacements[lag]}\n")
+    f.close()
+
 def get_diffusion_coef(traj_list, params, channel=None):
-    diffusion_coefs = []
-    loc_precisions = []
-    for traj in traj_list:
-        trajectory_length = traj.length
-        if trajectory_length < params.msd_num_points + 1:
-            continue
-        MSD = np.zeros(trajectory_length - 1)  # mean squared displacement
-        n = np.zeros(
-            trajectory_length - 1
-        )  # used to measure number of trajectories of given length for weighting
-        tau = np.zeros(trajectory_length - 1)  # times between MSDs
-        track_lengths = np.zeros(trajectory_length - 1)
-        x = np.array(traj.path)[:, 0] * params.pixel_size
-        y = np.array(traj.path)[:, 1] * params.pixel_size
-        for i in range(1, trajectory_length):
-            sqd = (x[i:] - x[: trajectory_length - i]) ** 2 + (
-                y[i:] - y[: trajectory_length - i]
-            ) ** 2
-            MSD[i - 1] = np.mean(sqd)
-            track_lengths[i - 1] = len(sqd)
-            tau[i - 1] = i * params.frame_time
-        tau = tau[: params.msd_num_points]
-        MSD = MSD[: params.msd_num_points]
-        track_lengths = track_lengths[: params.msd_num_points]
-        weights = track_lengths[: params.msd_num_points].astype("float32") / float(
-            np.amax(track_lengths[: params.msd_num_points])
-        )
-        plt.plot(tau, MSD)
+    tau, msds, weights = get_msds(traj_list, params)
+    gradients, intercepts = fit_straight_lines(tau, msds, weights)
+    fitted = np.isfinite(gradients) & np.isfinite(intercepts)
+    for i in range(np.count_nonzero(~fitted)):
+        print("WARNING: Unable to fit curve")
+
+    diffusion_coefs = list(gradients[fitted] / 4.0)
+    loc_precisions = list(np.sqrt(intercepts[fitted & (intercepts > 0)]) / 4.0)
+    if params.full_msd:
+        write_ensemble_msd(traj_list, params, channel)
+
+    if params.display_figures:
+        plt.plot(tau, msds.T)
         plt.xlabel(r"$\tau$")
         plt.ylabel("MSD ($\mu$m$^2$)")
-        try:
-            popt, pcov = curve_fit(straightline, tau, MSD, p0=[1, 0], sigma=weights)
-            # if popt[0] > 0:
-            diffusion_coefs.append(popt[0] / 4.0)
-            if popt[1] > 0:
-                loc_precisions.append(np.sqrt(popt[1]) / 4.0)
-        except:
-            print("WARNING: Unable to fit curve")
-    if params.display_figures:
         plt.show()
-    plt.close()
+        plt.close()
     plt.hist(diffusion_coefs)
     plt.xlabel("Diffusion coefficient ($\mu$m$^{2}$s$^{-1}$)")
     plt.ylabel("Number of foci trajectories")
@@ -432,20 +449,53 @@ def get_diffusion_coef(traj_list, params, channel=None):
 
 
 def plot_traj_intensities(params, trajs, channel=None, chung_kennedy=True):
-    if chung_kennedy: ck_data = []
     for traj in trajs:
         t = np.array(traj.intensity)
         plt.plot(t/10**3)
-        #ck_data.append(chung_kennedy_filter(t,params.chung_kennedy_window,1)[0][:-1])
-    ofile = params.name+"_chung_kennedy_data.csv"
-    f = open(ofile, 'w')
-    ck_data = np.array(ck_data)
-    for ck in range(len(ck_data)): 
-        f.write(str(ck_data[ck][0]))
-        for j in range(len(ck_data[ck])): 
-            f.write(","+str(ck_data[ck][j]))
-        f.write("\n")
-    f.close()
+
+    if chung_kennedy:
+        # Filter the traces spanning the same number of frames together,
+        # leaving out the last frame of each trajectory, which the filter
+        # drops. The filter assumes one point per frame, so the intensity in
+        # any frames a trajectory skipped is interpolated from its neighbours.
+        window = params.chung_kennedy_window
+        ck_intensity = np.zeros(len(trajs.intensity))
+        filtered = np.zeros(len(trajs.intensity), dtype=bool)
+        long_enough = np.flatnonzero(trajs.lengths >= window)
+        spans = trajs.spans[long_enough]
+        for span in np.unique(spans):
+            group = long_enough[spans == span]
+            traces = trajs.frame_grid(trajs.intensity, group)
+            for trace in np.flatnonzero(np.any(np.isnan(traces), axis=1)):
+                missing = np.isnan(traces[trace])
+                traces[trace, missing] = np.interp(
+                    np.flatnonzero(missing), np.flatnonzero(~missing), traces[trace, ~missing]
+                )
+
+            rows, owner, frames = trajs.frame_rows(group)
+            kept = frames < span - 1
+            ck_traces = chung_kennedy_filter(traces, window, 1)
+            ck_intensity[rows[kept]] = ck_traces[owner[kept], frames[kept]]
+            filtered[rows[kept]] = True
+
+        if channel=="L":
+            ofile = params.name+"_Lchannel_chung_kennedy_data.tsv"
+        elif channel=="R":
+            ofile = params.name+"_Rchannel_chung_kennedy_data.tsv"
+        else:
+            ofile = params.name+"_chung_kennedy_data.tsv"
+        columns = [
+            np.repeat(trajs.ids, trajs.lengths)[filtered],
+            trajs.frame[filtered],
+            trajs.intensity[filtered],
+            ck_intensity[filtered],
+        ]
+        f = open(ofile, 'w')
+        f.write("trajectory\tframe\tintensity\tCK_intensity\n")
+        text = [map(str, column.tolist()) for column in columns]
+        f.write("".join(line + "\n" for line in map("\t".join, zip(*text))))
+        f.close()
+
     plt.xlabel("Frame number")
     plt.ylabel("Intensity (camera counts per pixel x$10^3$)")
     if channel=="L":
@@ -463,8 +513,9 @@ def plot_traj_intensities(params, trajs, channel=None, chung_kennedy=True):
         plt.show()
     plt.close()
     if chung_kennedy:
-        for ck in ck_data:
-            plt.plot(ck)
+        for start, stop in zip(trajs.offsets, trajs.offsets + trajs.lengths):
+            if filtered[start]:
+                plt.plot(ck_intensity[start:stop-1])
         plt.xlabel("Frame number")
         plt.ylabel("Intensity (camera counts per pixel x$10^3$)")
         if channel=="L":
@@ -483,51 +534,42 @@ def plot_traj_intensities(params, trajs, channel=None, chung_kennedy=True):
         plt.close()
 
 def get_stoichiometries(trajs, isingle, params, channel=None):
-    # Let's do the easy part first - the ones where they do not start at the start
-    stoics = []
-    startframe = 100000
-    for traj in trajs:
-        if traj.start_frame<startframe and traj.length>=params.num_stoic_frames: startframe=traj.start_frame
-        # print(startframe)
-    for traj in trajs:
-        if traj.length <params.num_stoic_frames:
-            continue
-        if params.stoic_method == "Initial":
-            # Initial intensity
-            traj.stoichiometry = traj.intensity[0] / isingle
-            traj.stoichiometry = traj.stoichiometry[0]
-        elif params.stoic_method == "Mean":
-            # Mean of first N frames
-            traj.stoichiometry = (
-                np.mean(traj.intensity[: params.num_stoic_frames]) / isingle
-                )
-        elif params.stoic_method == "Linear":
-            if traj.start_frame-startframe>4:
-                continue #stoics.append(traj.intensity[0] / isingle)
-            else:
-                xdata = (
-                    np.arange(0, params.num_stoic_frames , dtype="float")
-                    # * params.frameTime
-                )
-                ydata = traj.intensity[0: params.num_stoic_frames]
-                popt, pcov = curve_fit(straightline, xdata, ydata)
-                intercept = popt[1]
-                print(popt)
-                if intercept > 0:  #and popt[0]<0 and startframe!=100000:
-                    traj.stoichiometry = (intercept + abs((traj.start_frame-startframe)*popt[0])) / isingle
-                    traj.stoichiometry = traj.stoichiometry[0]
-                else:
-                    continue 
-                    # traj.stoichiometry = traj.intensity[0] / isingle
-        stoics.append(traj.stoichiometry)
-    #print(stoics)
-    stoics = np.array(stoics)
+    # Use the first num_stoic_frames intensities of every trajectory that has
+    # that many, all at once
+    num_frames = params.num_stoic_frames
+    isingle = np.ravel(isingle)[0]
+    used = np.flatnonzero(trajs.lengths >= num_frames)
+    rows = trajs.offsets[used, np.newaxis] + np.arange(num_frames)
+    intensities = trajs.intensity[rows]
+    start_frames = trajs.frame[rows[:, 0]]
+    startframe = start_frames.min(initial=100000)
+
+    if params.stoic_method == "Initial":
+        # Initial intensity
+        stoics = intensities[:, 0] / isingle
+    elif params.stoic_method == "Mean":
+        # Mean of first N frames
+        stoics = np.mean(intensities, axis=1) / isingle
+    elif params.stoic_method == "Linear":
+        # Extrapolate a straight line through the first N spots back to the
+        # start of the first trajectory. The spots are placed at their frames,
+        # so any frames a trajectory skipped are accounted for. Trajectories
+        # that start well after it or have a negative intercept are left out.
+        xdata = (trajs.frame[rows] - start_frames[:, np.newaxis]).astype("float")
+        gradients, intercepts = fit_straight_lines(xdata, intensities)
+        delay = start_frames - startframe
+        fitted = (delay <= 4) & (intercepts > 0)
+        used = used[fitted]
+        stoics = (intercepts[fitted] + np.abs(delay[fitted] * gradients[fitted])) / isingle
+
+    for traj, stoichiometry in zip(used, stoics):
+        trajs[traj].stoichiometry = stoichiometry
+
     max_stoic = int(np.round(np.amax(stoics)))
 
     bandwidth = 0.7
-    kde = gaussian_kde(stoics, bw_method=bandwidth)
     x = np.linspace(0, max_stoic, max_stoic)
-    pdf = kde.evaluate(x)
+    pdf = binned_kde(stoics, x, bandwidth)
     
     fig, ax1 = plt.subplots()
     l1 = ax1.hist(
@@ -14,6 +14,9 @@ Description:
 
 Contains:
     class Spots
+    function find_candidates
+    function spot_mask
+    function extract_patches
 
 Author:
     Edward Higgins
@@ -22,13 +25,20 @@ Version: 0.2.0
 """
 
 import sys
+from functools import lru_cache
 
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
 from algorithms import *
 
+# Largest number of channels OpenCV will filter in a single call
+_CV_MAX_CHANNELS = 128
+
 
 class Spots:
     def __init__(self, num_spots=0, frame=0):
@@ -60,80 +70,39 @@ class Spots:
         self.snr = np.zeros([self.num_spots])
         self.converged = np.zeros([self.num_spots],dtype=np.int8)
 
-        for i in range(self.num_spots):
-            self.positions[i, :] = positions[i]
+        if self.num_spots > 0:
+            self.positions[:, :] = positions
 
     def find_in_frame(self, frame, params):
-        img_frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-
-        # Get structural element (map with disk of ones in a square of 0s) [strel]
-        disk_size = 2 * params.struct_disk_radius - 1
-        disk_kernel = cv2.getStructuringElement(
-            cv2.MORPH_ELLIPSE, (disk_size, disk_size)
-        )
-
-        # Optionally apply gaussian filtering to the frame
-        if params.filter_image == "Gaussian":
-            blurred_frame = cv2.GaussianBlur(img_frame, (3, 3), 0)
-        else:
-            blurred_frame = img_frame.copy()
-
-        # Apply top-hat filtering [imtophat]
-        tophatted_frame = cv2.morphologyEx(blurred_frame, cv2.MORPH_TOPHAT, disk_kernel)
-
-        # Get b/w threshold value from the histogram
-        hist_data = cv2.calcHist([tophatted_frame], [0], None, [256], [0, 256])
-        hist_data[0] = 0
-
-        peak_width, peak_location = fwhm(hist_data)
-        bw_threshold = int(peak_location + params.bw_threshold_tolerance * peak_width)
-
-        # Apply gaussian filter to the top-hatted image [fspecial, imfilter]
-        blurred_tophatted_frame = cv2.GaussianBlur(tophatted_frame, (3, 3), 0)
-
-        # Convert the filtered image to b/w [im2bw]
-        bw_frame = cv2.threshold(
-            blurred_tophatted_frame, bw_threshold, 255, cv2.THRESH_BINARY
-        )[1]
-
-        # "Open" the b/w image (in a morphological sense) [imopen]
-        bw_opened = cv2.morphologyEx(
-            bw_frame, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
-        )
-
-        # Fill holes ofsize 1 pixel in the resulting image [bwmorph]
-        bw_filled = cv2.morphologyEx(
-            bw_opened,
-            cv2.MORPH_CLOSE,
-            cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)),
-        )
-
-        spot_locations = ultimate_erode(bw_filled[:, :, 0], frame)
-        if np.isnan(spot_locations).any():
-            raise "Found nans"
+        spot_locations = find_candidates(frame[np.newaxis, :, :], params)[0]
         self.set_positions(spot_locations)
 
     def merge_coincident_candidates(self):
-        new_positions = []
-        skip = []
-        for i in range(self.num_spots):
-            tmp_positions = [self.positions[i, :]]
-            if i in skip:
-                continue
-
-            for j in range(i + 1, self.num_spots):
-                if sum((self.positions[i, :] - self.positions[j, :]) ** 2) < 4:
-                    skip.append(j)
-                    tmp_positions.append(self.positions[j, :])
-
-            p = [0, 0]
-            for pos in tmp_positions:
-                p[0] += pos[0]
-                p[1] += pos[1]
-            p[0] = p[0] / len(tmp_positions)
-            p[1] = p[1] / len(tmp_positions)
+        if self.num_spots == 0:
+            self.set_positions([])
+            return
+
+        # Find every pair of candidates within 2 pixels of each other
+        positions = np.asarray(self.positions, dtype=float)
+        pairs = cKDTree(positions).query_pairs(2.0, output_type="ndarray")
+        pair_dist_sq = np.sum((positions[pairs[:, 0]] - positions[pairs[:, 1]]) ** 2, axis=1)
+        pairs = pairs[pair_dist_sq < 4]
+
+        # Merge each connected cluster of candidates into its mean position,
+        # keeping the clusters in order of their first candidate
+        adjacency = coo_matrix(
+            (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+            shape=(self.num_spots, self.num_spots),
+        )
+        num_clusters, labels = connected_components(adjacency, directed=False)
+        cluster_order = np.argsort(np.unique(labels, return_index=True)[1])
+        labels = np.argsort(cluster_order)[labels]
 
-            new_positions.append(p)
+        counts = np.bincount(labels, minlength=num_clusters)
+        new_positions = np.column_stack([
+            np.bincount(labels, weights=positions[:, d], minlength=num_clusters) / counts
+            for d in (0, 1)
+        ])
 
         self.set_positions(new_positions)
 
@@ -221,169 +190,343 @@ class Spots:
             if self.traj_num[i] == -1:
                 sys.exit(f"Unable to find a match for spot {i}, frame {self.frame}")
 
-    def get_spot_intensities(self, frame, params):
-        for i in range(self.num_spots):
-            x = round(self.positions[i, 0])
-            y = round(self.positions[i, 1])
-            # Create a tmp array with the centre of the spot in the centre
-            tmp = frame[
-                y - params.subarray_halfwidth : y + params.subarray_halfwidth+1, 
-                x - params.subarray_halfwidth : x + params.subarray_halfwidth + 1
-            ] 
-            spotmask = np.zeros(tmp.shape)
-            cv2.circle(spotmask, 
-                    (params.subarray_halfwidth, params.subarray_halfwidth),
-                    params.inner_mask_radius,
-                    1,
-                    -1
-            )
-            bgintensity = np.mean(tmp[spotmask == 0])
-            tmp = tmp - bgintensity
-            intensity = np.sum(tmp[spotmask == 1])
-            if intensity == 0:
-                print(f"WARNING: Zero intensity found at {[x, y]}")
-            self.spot_intensity[i] = intensity
+    def get_spot_patches(self, frame, params):
+        """Background-corrected sub-image around each spot, [spot, y, x]
 
-    def refine_centres(self, frame, params):
-        image = frame.as_image()
-        # Refine the centre of each spot independently
-        for i_spot in range(self.num_spots):
-            r = params.subarray_halfwidth
-            N = 2 * r + 1
-
-            # Get the centre estimate, make sure the spot_region fits in the frame
-            p_estimate = self.positions[i_spot, :]
-            for d in (0, 1):
-                if round(p_estimate[d]) < r:
-                    p_estimate[d] = r
-                elif round(p_estimate[d]) > frame.frame_size[d]-r-1:
-                    p_estimate[d] = frame.frame_size[d] - r - 1
-
-            # Create the sub-image
-            spot_region = np.array(
-                [
-                    [round(p_estimate[0]) - r, round(p_estimate[0]) + r],
-                    [round(p_estimate[1]) - r, round(p_estimate[1]) + r],
-                ]
-            ).astype(int)
-
-            spot_pixels = image[
-                spot_region[1, 0] : spot_region[1, 1] + 1,
-                spot_region[0, 0] : spot_region[0, 1] + 1,
-            ]
-
-            coords = np.mgrid[
-                spot_region[0, 0] : spot_region[0, 1] + 1,
-                spot_region[1, 0] : spot_region[1, 1] + 1,
-            ]
-
-            Xs, Ys = np.meshgrid(
-                range(spot_region[0, 0], spot_region[0, 1] + 1),
-                range(spot_region[1, 0], spot_region[1, 1] + 1),
-            )
+        Pixels that fall outside the frame are NaN, and are left out of the
+        background estimate.
+        """
+        r = params.subarray_halfwidth
+        corners = np.round(self.positions).astype(int).reshape(-1, 2) - r
+        patches = extract_patches(frame, corners, 2 * r + 1, fill_value=np.nan)
 
-            converged = False
-            iteration = 0
-            clipping = False
-            spot_intensity = 0
-            bg_intensity = 0
-            snr = 0
-            while not converged and iteration < params.gauss_mask_max_iter:
-                iteration += 1
-
-                # Generate the inner mask
-                inner_mask = np.where(
-                    (coords[0, :, :] - p_estimate[0]) ** 2
-                    + (coords[1, :, :] - p_estimate[1]) ** 2
-                    <= params.inner_mask_radius ** 2,
-                    1,
-                    0,
-                )
-                mask_pixels = np.sum(inner_mask)
-
-                # Generate the Gaussian mask
-                # This uses Numpy magic, it's almost as bad as the MATLAB...
-                coords_sq = (
-                    coords[:, :, :] - p_estimate[:, np.newaxis, np.newaxis]
-                ) ** 2
-                exponent = -(coords_sq[0, :, :] + coords_sq[1, :, :]) / (
-                    2 * params.gauss_mask_sigma ** 2
-                )
-                gauss_mask = np.exp(exponent)
+        bg_pixels = ~np.isnan(patches) & ~spot_mask(r, params.inner_mask_radius)
+        bg_intensity = np.sum(np.where(bg_pixels, patches, 0), axis=(1, 2)) / np.sum(
+            bg_pixels, axis=(1, 2)
+        )
+        patches -= bg_intensity[:, np.newaxis, np.newaxis]
 
-                if np.sum(gauss_mask) != 0:
-                    gauss_mask /= np.sum(gauss_mask)
+        return patches
 
-                bg_mask = 1 - inner_mask
+    def get_spot_intensities(self, frame, params, patches=None):
+        if patches is None:
+            patches = self.get_spot_patches(frame, params)
 
-                # Calculate the local background intensity and subtract it off the sub-image
-                spot_bg = spot_pixels * bg_mask
-                num_bg_spots = np.sum(bg_mask)
-                bg_average = np.sum(spot_bg) / num_bg_spots
+        inner_mask = spot_mask(params.subarray_halfwidth, params.inner_mask_radius)
+        intensities = np.sum(np.where(inner_mask, np.nan_to_num(patches), 0), axis=(1, 2))
+        for i in np.flatnonzero(intensities == 0):
+            x = round(self.positions[i, 0])
+            y = round(self.positions[i, 1])
+            print(f"WARNING: Zero intensity found at {[x, y]}")
+        self.spot_intensity[:] = intensities
 
-                # Calculate background corrected sub-image
-                bg_corr_spot_pixels = spot_pixels - bg_average
+    def measure(self, frame, params):
+        """Refine, filter and measure the spots in a frame
 
-                # Calculate revised position estimate
-                spot_gaussian_product = bg_corr_spot_pixels * gauss_mask
-                p_estimate_new = np.zeros(2)
-                p_estimate_new[0] = np.sum(spot_gaussian_product * Xs) / np.sum(
-                    spot_gaussian_product
-                )
-                p_estimate_new[1] = np.sum(spot_gaussian_product * Ys) / np.sum(
-                    spot_gaussian_product
-                )
-                estimate_change = np.linalg.norm(p_estimate - p_estimate_new)
+        The intensities and widths are measured from a single set of
+        background-corrected sub-images, gathered once for all the spots.
+        """
+        self.refine_centres(frame, params)
+        self.filter_candidates(frame, params)
 
-                if not np.isnan(p_estimate_new).any():
-                    p_estimate = p_estimate_new
-                else:
-                    print("WARNING: Position estimate is NaN, falied to converge")
-                    break
+        patches = self.get_spot_patches(frame.pixel_data[0, :, :], params)
+        self.get_spot_intensities(None, params, patches)
+        self.get_spot_widths(None, params, patches)
 
-                spot_intensity = np.sum(bg_corr_spot_pixels * inner_mask)
-                bg_std = np.std(spot_bg[bg_mask==1])
+    def refine_centres(self, frame, params):
+        if self.num_spots == 0:
+            return
+        # Refine on the pixels in the dtype the stack was read with; only the
+        # candidate search needs the uint16 image
+        image = frame.pixel_data[0, :, :]
+        r = params.subarray_halfwidth
+        N = 2 * r + 1
+
+        # Get the centre estimates, make sure the spot regions fit in the frame
+        p_estimate = self.positions.astype(float)
+        for d in (0, 1):
+            rounded = np.round(p_estimate[:, d])
+            p_estimate[:, d] = np.where(rounded < r, r, p_estimate[:, d])
+            p_estimate[:, d] = np.where(
+                rounded > frame.frame_size[d] - r - 1,
+                frame.frame_size[d] - r - 1,
+                p_estimate[:, d],
+            )
 
+        # Extract the sub-image around every spot at once, giving [spot, y, x]
+        corners = np.round(p_estimate).astype(int) - r
+        spot_pixels = extract_patches(image, corners, N).astype(float)
+
+        # Pixel coordinates, [spot, offset]. The masks are indexed [spot, x, y]
+        # while spot_pixels are [spot, y, x]; this matches the original
+        # per-spot implementation and is kept for consistency of results
+        offsets = np.arange(N)
+        Xs = (corners[:, 0, np.newaxis] + offsets)[:, np.newaxis, :]
+        Ys = (corners[:, 1, np.newaxis] + offsets)[:, :, np.newaxis]
+
+        def spot_statistics(spots, p):
+            # Inner mask, background and background-corrected pixels around p
+            dx_sq = ((corners[spots, 0, np.newaxis] + offsets) - p[:, 0, np.newaxis]) ** 2
+            dy_sq = ((corners[spots, 1, np.newaxis] + offsets) - p[:, 1, np.newaxis]) ** 2
+            dist_sq = dx_sq[:, :, np.newaxis] + dy_sq[:, np.newaxis, :]
+            inner_mask = np.where(dist_sq <= params.inner_mask_radius ** 2, 1, 0)
+            bg_mask = 1 - inner_mask
+
+            # Calculate the local background intensity and subtract it off the sub-image
+            num_bg_spots = np.sum(bg_mask, axis=(1, 2))
+            bg_average = np.sum(spot_pixels[spots] * bg_mask, axis=(1, 2)) / num_bg_spots
+            bg_corr_spot_pixels = spot_pixels[spots] - bg_average[:, np.newaxis, np.newaxis]
+
+            return dist_sq, inner_mask, bg_mask, num_bg_spots, bg_average, bg_corr_spot_pixels
+
+        def signal_to_noise(spots, inner_mask, bg_mask, num_bg_spots, bg_average, spot_intensity):
+            bg_deviation_sq = (spot_pixels[spots] - bg_average[:, np.newaxis, np.newaxis]) ** 2
+            bg_std = np.sqrt(np.sum(bg_deviation_sq * bg_mask, axis=(1, 2)) / num_bg_spots)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.abs(spot_intensity / (bg_std * np.sum(inner_mask, axis=(1, 2))))
+
+        if params.refinement_method == "Radial":
+            # Non-iterative estimate, then measure the spots once at that position
+            spots = np.arange(self.num_spots)
+            p_new = corners + radial_symmetry_centres(spot_pixels)
+            converged = ~np.isnan(p_new).any(axis=1)
+            for i in range(np.sum(~converged)):
+                print("WARNING: Position estimate is NaN, falied to converge")
+            p_estimate[converged, :] = p_new[converged, :]
+
+            dist_sq, inner_mask, bg_mask, num_bg_spots, bg_intensity, bg_corr_spot_pixels = \
+                spot_statistics(spots, p_estimate)
+            spot_intensity = np.sum(bg_corr_spot_pixels * inner_mask, axis=(1, 2))
+            snr = signal_to_noise(
+                spots, inner_mask, bg_mask, num_bg_spots, bg_intensity, spot_intensity
+            )
 
-                if estimate_change < 1e-6:
-                    converged = True
+            self.bg_intensity[:] = bg_intensity
+            self.spot_intensity[:] = spot_intensity
+            self.snr[:] = snr
+            self.converged[:] = converged
+            self.positions[:, :] = p_estimate
+            return
+
+        converged = np.zeros(self.num_spots, dtype=bool)
+        spot_intensity = np.zeros(self.num_spots)
+        bg_intensity = np.zeros(self.num_spots)
+        snr = np.zeros(self.num_spots)
+
+        # Iterate all the spots together, dropping them as they finish
+        active = np.arange(self.num_spots)
+        iteration = 0
+        while active.size > 0 and iteration < params.gauss_mask_max_iter:
+            iteration += 1
+            p = p_estimate[active, :]
+
+            dist_sq, inner_mask, bg_mask, num_bg_spots, bg_average, bg_corr_spot_pixels = \
+                spot_statistics(active, p)
+
+            # Generate the Gaussian mask
+            gauss_mask = np.exp(-dist_sq / (2 * params.gauss_mask_sigma ** 2))
+            gauss_sum = np.sum(gauss_mask, axis=(1, 2))
+            gauss_mask /= np.where(gauss_sum != 0, gauss_sum, 1)[:, np.newaxis, np.newaxis]
+
+            # Calculate revised position estimates
+            spot_gaussian_product = bg_corr_spot_pixels * gauss_mask
+            product_sum = np.sum(spot_gaussian_product, axis=(1, 2))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                p_new = np.column_stack((
+                    np.sum(spot_gaussian_product * Xs[active], axis=(1, 2)) / product_sum,
+                    np.sum(spot_gaussian_product * Ys[active], axis=(1, 2)) / product_sum,
+                ))
+            estimate_change = np.linalg.norm(p - p_new, axis=1)
+            bg_intensity[active] = bg_average
+
+            failed = np.isnan(p_new).any(axis=1)
+            for i in range(np.sum(failed)):
+                print("WARNING: Position estimate is NaN, falied to converge")
+
+            ok = ~failed
+            p_estimate[active[ok], :] = p_new[ok, :]
+
+            spot_intensity[active[ok]] = np.sum(
+                bg_corr_spot_pixels[ok] * inner_mask[ok], axis=(1, 2)
+            )
 
-                # Calculate signal-noise ratio
-                # Don't bother reiterating this spot if it's too low
-                snr = abs(spot_intensity / (bg_std*np.sum(inner_mask)))
-#EJH#                 snr = abs(spot_intensity / (bg_std*np.sum(inner_mask)))
-                if snr <= params.snr_filter_cutoff:
-                    break
+            converged[active[ok]] = estimate_change[ok] < 1e-6
 
-            self.bg_intensity[i_spot] = bg_average
-            self.spot_intensity[i_spot] = spot_intensity
-            self.snr[i_spot] = snr
-            self.converged[i_spot] = converged
+            # Calculate signal-noise ratio
+            # Don't bother reiterating spots if they're too low
+            snr[active[ok]] = signal_to_noise(
+                active[ok], inner_mask[ok], bg_mask[ok], num_bg_spots[ok],
+                bg_average[ok], spot_intensity[active[ok]],
+            )
 
-            self.positions[i_spot, :] = p_estimate
-            
-    def get_spot_widths(self, frame, params):
-        for i in range(self.num_spots):
-            x = round(self.positions[i, 0])
-            y = round(self.positions[i, 1])
-            # Create a tmp array with the centre of the spot in the centre
-            tmp = frame[
-                y - params.subarray_halfwidth : y + params.subarray_halfwidth+1, 
-                x - params.subarray_halfwidth : x + params.subarray_halfwidth + 1
-                ] 
-            spotmask = np.zeros(tmp.shape)
-            cv2.circle(spotmask, 
-             (params.subarray_halfwidth, params.subarray_halfwidth),
-             params.inner_mask_radius,
-             1,
-             -1
-             )
-            bgintensity = np.mean(tmp[spotmask == 0])
-            tmp = tmp - bgintensity
-            p, succ = fit2Dgaussian(tmp)
-            if succ==1: # the fit is OK
-                self.width[i,0] = p[3]
-                self.width[i,1] = p[4]
-            else: # something went wrong
-                self.width[i,0] = params.psf_width
-                self.width[i,1] = params.psf_width
+            finished = failed.copy()
+            finished[ok] = converged[active[ok]] | (snr[active[ok]] <= params.snr_filter_cutoff)
+            active = active[~finished]
+
+        self.bg_intensity[:] = bg_intensity
+        self.spot_intensity[:] = spot_intensity
+        self.snr[:] = snr
+        self.converged[:] = converged
+
+        self.positions[:, :] = p_estimate
+
+    def get_spot_widths(self, frame, params, patches=None):
+        if self.num_spots == 0:
+            return
+        if patches is None:
+            patches = self.get_spot_patches(frame, params)
+
+        # Fit all the spots at once, falling back to the PSF width where the
+        # fit went wrong
+        p, success = fit_gaussians(patches)
+        self.width[:, 0] = np.where(success, p[:, 3], params.psf_width)
+        self.width[:, 1] = np.where(success, p[:, 4], params.psf_width)
+
+
+def find_candidates(frames, params):
+    """FIND_CANDIDATES - Find candidate spot positions in a block of frames
+
+    Description:
+        Runs the spot detection chain (blur, top-hat, threshold, open/close,
+        ultimate erosion) on a whole block of single-channel frames at once.
+        The frames are stacked as the channels of a single image so that each
+        OpenCV filter is called once per block rather than once per frame;
+        OpenCV filters every channel independently, so the result is the same
+        as filtering the frames one at a time.
+
+    Inputs:
+        np.array([N, rows, cols]): frames
+            uint16 frames to search
+
+        Parameters: params
+            Run parameters
+
+    Outputs:
+        list: candidates
+            An (M, 2) array of [x, y] candidate positions for each frame
+    """
+    num_frames = frames.shape[0]
+    block = np.ascontiguousarray(np.moveaxis(frames, 0, -1))
+
+    # Get structural element (map with disk of ones in a square of 0s) [strel]
+    disk_size = 2 * params.struct_disk_radius - 1
+    disk_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (disk_size, disk_size))
+
+    def filter_block(block, filter_function):
+        # Apply filter_function to the block in groups OpenCV can handle
+        filtered = np.empty_like(block)
+        for start in range(0, num_frames, _CV_MAX_CHANNELS):
+            channels = slice(start, start + _CV_MAX_CHANNELS)
+            filtered[:, :, channels] = filter_function(
+                np.ascontiguousarray(block[:, :, channels])
+            ).reshape(filtered[:, :, channels].shape)
+        return filtered
+
+    # Optionally apply gaussian filtering to the frames
+    if params.filter_image == "Gaussian":
+        block = filter_block(block, lambda img: cv2.GaussianBlur(img, (3, 3), 0))
+
+    # Apply top-hat filtering [imtophat]
+    tophatted_block = filter_block(
+        block, lambda img: cv2.morphologyEx(img, cv2.MORPH_TOPHAT, disk_kernel)
+    )
+
+    # Get b/w threshold value for each frame from its histogram of the values
+    # below 256, counted for all the frames at once
+    in_range = tophatted_block < 256
+    hist_block = np.bincount(
+        (np.arange(num_frames) * 256 + tophatted_block)[in_range],
+        minlength=num_frames * 256,
+    ).reshape(num_frames, 256).astype(np.float32)
+
+    bw_thresholds = np.zeros(num_frames)
+    for frame in range(num_frames):
+        hist_data = hist_block[frame]
+        hist_data[0] = 0
+
+        peak_width, peak_location = fwhm(hist_data)
+        bw_thresholds[frame] = int(peak_location + params.bw_threshold_tolerance * peak_width)
+
+    # Apply gaussian filter to the top-hatted image [fspecial, imfilter]
+    blurred_tophatted_block = filter_block(
+        tophatted_block, lambda img: cv2.GaussianBlur(img, (3, 3), 0)
+    )
+
+    # Convert the filtered images to b/w [im2bw]
+    bw_block = np.where(blurred_tophatted_block > bw_thresholds, 255, 0).astype(np.uint8)
+
+    # "Open" the b/w image (in a morphological sense) [imopen]
+    bw_opened = filter_block(
+        bw_block,
+        lambda img: cv2.morphologyEx(
+            img, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        ),
+    )
+
+    # Fill holes ofsize 1 pixel in the resulting image [bwmorph]
+    bw_filled = filter_block(
+        bw_opened,
+        lambda img: cv2.morphologyEx(
+            img, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        ),
+    )
+
+    candidates = []
+    for frame in range(num_frames):
+        spot_locations = ultimate_erode(
+            bw_filled[:, :, frame], frames[frame], params.erosion_method
+        )
+        if np.isnan(spot_locations).any():
+            raise "Found nans"
+        candidates.append(spot_locations)
+
+    return candidates
+
+
+@lru_cache(maxsize=None)
+def spot_mask(halfwidth, radius):
+    """SPOT_MASK - Boolean disk of the given radius in a (2*halfwidth+1)^2 square
+
+    The mask is cached, so it must not be modified.
+    """
+    mask = np.zeros((2 * halfwidth + 1, 2 * halfwidth + 1))
+    cv2.circle(mask, (halfwidth, halfwidth), radius, 1, -1)
+    mask = mask == 1
+    mask.flags.writeable = False
+    return mask
+
+
+def extract_patches(image, corners, size, fill_value=None):
+    """EXTRACT_PATCHES - Cut a square sub-image out of a frame for each spot
+
+    Inputs:
+        np.array([rows, cols]): image
+            Frame to take the sub-images from
+
+        np.array([N, 2]): corners
+            [x, y] of the top left pixel of each sub-image
+
+        int: size
+            Width and height of the sub-images
+
+        float: fill_value
+            If given, pixels outside the image are set to this value (and the
+            patches are returned as floats). Otherwise every sub-image must
+            lie inside the image.
+
+    Outputs:
+        np.array([N, size, size]): patches
+            The sub-images, indexed [spot, y, x]
+    """
+    offsets = np.arange(size)
+    rows = (corners[:, 1, np.newaxis] + offsets)[:, :, np.newaxis]
+    cols = (corners[:, 0, np.newaxis] + offsets)[:, np.newaxis, :]
+    if fill_value is None:
+        return image[rows, cols]
+
+    inside = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+    patches = image[
+        np.clip(rows, 0, image.shape[0] - 1), np.clip(cols, 0, image.shape[1] - 1)
+    ].astype(float)
+    patches[~inside] = fill_value
+    return patches
@@ -14,6 +14,10 @@ Description:
 
 Contains:
     function track
+    function track_images
+    function detect_spots
+    function track_frames
+    function track_frame
 
 Author:
     Edward Higgins
@@ -22,9 +26,11 @@ Version: 0.2.0
 """
 
 import sys
+from collections import deque
 
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import spots
 import trajectories
@@ -37,69 +43,227 @@ def track(params):
     image_data.read(params.name + ".tif", params)
 
     if params.ALEX==True:
-        imageL=np.zeros((image_data.num_frames//2,image_data.frame_size[1],image_data.frame_size[0]//2))
-        imageR=np.zeros((image_data.num_frames//2,image_data.frame_size[1],image_data.frame_size[0]//2))
-        if params.start_channel=='L':
-            for i in range(0,image_data.num_frames-1,2):
-                imageL[i//2,:,:] = image_data.pixel_data[i,:,:image_data.frame_size[0]//2]
-                imageR[i//2,:,:] = image_data.pixel_data[i+1,:,image_data.frame_size[0]//2:]
-        else:
-            for i in range(0,image_data.num_frames-1,2):
-                imageR[i//2,:,:] = image_data.pixel_data[i,:,:image_data.frame_size[0]//2]
-                imageL[i//2,:,:] = image_data.pixel_data[i+1,:,image_data.frame_size[0]//2:]
-        image_data.num_frames = image_data.num_frames//2
-
-        #LHS
-        image_data.pixel_data = imageL
-        image_data.frame_size = [image_data.frame_size[0]//2,image_data.frame_size[1]]
-        all_spots = []
-        for frame in range(image_data.num_frames):
-            all_spots.append(track_frame(image_data[frame], frame, params))
-        trajs = trajectories.build_trajectories(all_spots, params)
-        trajectories.write_trajectories(trajs, params.name +  "_Lchannel_trajectories.tsv")
-
-        #RHS
-        image_data.pixel_data = imageR
-        all_spots = []
-        for frame in range(image_data.num_frames):
-            all_spots.append(track_frame(image_data[frame], frame, params))
-        trajs = trajectories.build_trajectories(all_spots, params)
-        trajectories.write_trajectories(trajs, params.name +  "_Rchannel_trajectories.tsv")
-
-    # For each frame, detect spots
+        imageL, imageR = images.split_alex(image_data, params.start_channel)
+        track_images(
+            [imageL, imageR],
+            params,
+            [
+                trajectories.trajectory_filename(params.name + "_Lchannel_trajectories", params),
+                trajectories.trajectory_filename(params.name + "_Rchannel_trajectories", params),
+            ],
+        )
+
     else:
-        all_spots = []
-        if params.num_procs == 0:
-            for frame in range(image_data.num_frames):
-                all_spots.append(track_frame(image_data[frame], frame, params))
+        track_images(
+            [image_data],
+            params,
+            [trajectories.trajectory_filename(params.name + "_trajectories", params)],
+        )
 
-        else:
-            res = [None] * image_data.num_frames
-            with mp.Pool(params.num_procs) as pool:
-                for frame in range(image_data.num_frames):
-                    res[frame] = pool.apply_async(track_frame, (image_data[frame], frame, params))
-                for frame in range(image_data.num_frames):
-                    all_spots.append(res[frame].get())
+def track_images(image_list, params, filenames):
+    # For each frame of each image, detect spots
+    detected = detect_spots(image_list, params)
 
+    if params.streaming and params.trajectory_format == "TSV":
+        # Link and write out trajectories as the frames are detected
+        linkers = [trajectories.Linker(params) for filename in filenames]
+        for filename in filenames:
+            trajectories.write_trajectories([], filename)
+        for channel, frame_spots in detected:
+            trajectories.write_trajectories(
+                linkers[channel].add_frame(frame_spots), filenames[channel], append=True
+            )
+        for linker, filename in zip(linkers, filenames):
+            trajectories.write_trajectories(linker.finish(), filename, append=True)
+
+    elif params.streaming:
+        # Binary files are written in one go, so only the linking is done as
+        # the frames are detected
+        linkers = [trajectories.Linker(params) for filename in filenames]
+        channel_trajs = [[] for filename in filenames]
+        for channel, frame_spots in detected:
+            channel_trajs[channel].append(linkers[channel].add_frame(frame_spots))
+        for linker, trajs, filename in zip(linkers, channel_trajs, filenames):
+            trajs.append(linker.finish())
+            trajs = linker.sort_by_creation(trajectories.TrajectoryData.concatenate(trajs))
+            trajectories.write_trajectories(trajs, filename)
+
+    else:
         # Link the spot trajectories across the frames
-        trajs = trajectories.build_trajectories(all_spots, params)
-        trajectories.write_trajectories(trajs, params.name + "_trajectories.tsv")
+        all_spots = [[] for filename in filenames]
+        for channel, frame_spots in detected:
+            all_spots[channel].append(frame_spots)
+        for channel_spots, filename in zip(all_spots, filenames):
+            trajs = trajectories.build_trajectories(channel_spots, params)
+            trajectories.write_trajectories(trajs, filename)
+
+def detect_spots(image_list, params):
+    """Generator yielding (image index, spots) for each frame of each image
+
+    Frames of a given image are always yielded in order. In parallel runs the
+    images are worked on concurrently, so their frames are interleaved.
+    """
+    chunk_size = max(params.frame_chunk_size, 1)
+    if params.num_procs == 0:
+        for channel, image_data in enumerate(image_list):
+            for start in range(0, image_data.num_frames, chunk_size):
+                stop = min(start + chunk_size, image_data.num_frames)
+                for frame_spots in track_frames(image_data, start, stop, params):
+                    yield channel, frame_spots
+
+    else:
+        # Memory-mapped stacks are opened by the workers themselves. Anything
+        # else is published through a ring of shared frames, which is filled
+        # as the frames are handed out; workers only get given the range of
+        # frames to work on
+        #
+        # Keep at most stream_window frames in flight at once, but make sure
+        # every worker has something to do
+        window = max(params.stream_window // chunk_size, params.num_procs)
+        shms = []
+        rings = []
+        stacks = []
+        try:
+            for image_data in image_list:
+                if image_data.dtype is not None:
+                    dtype = np.dtype(image_data.dtype)
+                else:
+                    dtype = image_data.pixel_data.dtype
+
+                source = _memmap_source(image_data.pixel_data)
+                if source is not None:
+                    rings.append(None)
+                    stacks.append((source, None, dtype, image_data.has_mask, image_data.mask_data))
+                    continue
+
+                # Chunks start on multiples of chunk_size, so they never wrap
+                # around the ring
+                shape = (
+                    min(window * chunk_size, image_data.num_frames),
+                    image_data.frame_size[1],
+                    image_data.frame_size[0],
+                )
+                shm = shared_memory.SharedMemory(
+                    create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1)
+                )
+                shms.append(shm)
+                rings.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+                stacks.append((None, (shm.name, shape), dtype, image_data.has_mask, image_data.mask_data))
 
-def track_frame(frame_data, frame, params):
-        # Find the spots in this frame
+            num_frames = max(image_data.num_frames for image_data in image_list)
+            res = deque()
+            with mp.Pool(
+                params.num_procs, initializer=_init_worker, initargs=(stacks, params)
+            ) as pool:
+                for start in range(0, num_frames, chunk_size):
+                    for channel, image_data in enumerate(image_list):
+                        if start >= image_data.num_frames:
+                            continue
+                        if len(res) >= window:
+                            channel_done, result = res.popleft()
+                            for frame_spots in result.get():
+                                yield channel_done, frame_spots
+                        stop = min(start + chunk_size, image_data.num_frames)
+                        ring = rings[channel]
+                        if ring is not None:
+                            # The frames that were in these slots have been
+                            # tracked, as at most window chunks are in flight
+                            for frame in range(start, stop):
+                                ring[frame % len(ring), :, :] = image_data.pixel_data[frame, :, :]
+                        res.append((channel, pool.apply_async(_track_chunk, (channel, start, stop))))
+                while res:
+                    channel_done, result = res.popleft()
+                    for frame_spots in result.get():
+                        yield channel_done, frame_spots
+        finally:
+            # Drop the views onto the rings before releasing them
+            rings = ring = None
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+def _memmap_source(pixel_data):
+    # Describe a view onto a memory-mapped file so that it can be opened again
+    # in another process, or None if the pixel data is not memory-mapped
+    if not isinstance(pixel_data, np.memmap):
+        return None
+    root = pixel_data
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    if root.filename is None:
+        return None
+
+    view_offset = pixel_data.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+    return (
+        root.filename, root.offset, root.shape, root.dtype,
+        view_offset, pixel_data.shape, pixel_data.strides,
+    )
+
+# Per-process state for the worker pool, set up by _init_worker
+_worker_shms = []
+_worker_images = []
+_worker_params = None
+
+def _init_worker(stacks, params):
+    global _worker_params
+    for source, ring, dtype, has_mask, mask_data in stacks:
+        image_data = images.ImageData()
+        if source is not None:
+            filename, offset, shape, file_dtype, view_offset, view_shape, strides = source
+            mapped = np.memmap(filename, dtype=file_dtype, mode="r", offset=offset, shape=shape)
+            image_data.pixel_data = np.ndarray(
+                view_shape, dtype=file_dtype, buffer=mapped, offset=view_offset, strides=strides
+            )
+        else:
+            shm_name, view_shape = ring
+            shm = shared_memory.SharedMemory(name=shm_name)
+            image_data.pixel_data = np.ndarray(view_shape, dtype=dtype, buffer=shm.buf)
+            _worker_shms.append(shm)
+        image_data.num_frames = view_shape[0]
+        image_data.frame_size = (view_shape[2], view_shape[1])
+        image_data.dtype = dtype
+        image_data.has_mask = has_mask
+        image_data.mask_data = mask_data
+        _worker_images.append(image_data)
+    _worker_params = params
+
+def _track_chunk(channel, start, stop):
+    # Ring stacks hold frame f in slot f % (ring length); a memory-mapped
+    # stack holds every frame, so its slot is just the frame number
+    image_data = _worker_images[channel]
+    return track_frames(image_data, start, stop, _worker_params, start % image_data.num_frames)
+
+def track_frames(image_data, start, stop, params, first=None):
+    # Frames start to stop are at image_data[first:], or image_data[start:] if
+    # first is not given
+    if first is None:
+        first = start
+
+    # Detect candidates for the whole block of frames at once
+    frames = [image_data[first + frame - start] for frame in range(start, stop)]
+    candidates = spots.find_candidates(
+        np.stack([frame_data.as_image() for frame_data in frames]), params
+    )
+
+    return [
+        track_frame(frame_data, frame, params, frame_candidates)
+        for frame, frame_data, frame_candidates in zip(range(start, stop), frames, candidates)
+    ]
+
+def track_frame(frame_data, frame, params, candidates=None):
+        # Find the spots in this frame, unless they have already been found
         frame_spots = spots.Spots(frame=frame)
-        frame_spots.find_in_frame(frame_data.as_image()[:, :], params)
+        if candidates is None:
+            frame_spots.find_in_frame(frame_data.as_image()[:, :], params)
+        else:
+            frame_spots.set_positions(candidates)
         found_spots = frame_spots.num_spots
         frame_spots.merge_coincident_candidates()
 
         merged_spots = frame_spots.num_spots
-        # Iteratively refine the spot centres
-        frame_spots.refine_centres(frame_data, params)
-
-        frame_spots.filter_candidates(frame_data, params)
+        # Iteratively refine the spot centres, filter them and measure them
+        frame_spots.measure(frame_data, params)
 
-        frame_spots.get_spot_intensities(frame_data.as_image()[:,:], params)
-        frame_spots.get_spot_widths(frame_data.as_image()[:,:], params)
         if params.verbose:
             print(
                 f"Frame {frame:4d}: found {frame_spots.num_spots:3d} spots "
@@ -15,7 +15,11 @@ Description:
 
 Contains:
     class Trajectory
+    class TrajectoryData
+    class Linker
+    function link_spots
     function build_trajectories
+    function trajectory_filename
     function read_trajectories
     function write_trajectories
 
@@ -25,261 +29,668 @@ Author:
 Version: 0.2.0
 """
 
-import csv
-import sys
 import os
+import sys
+import warnings
+from collections.abc import Sequence
+from itertools import chain
 
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from spots import Spots
 
 
 class Trajectory:
-    def __init__(self, id, spots, spot_id):
-        self.id = id
-        self.start_frame = spots.frame
-        self.end_frame = spots.frame
-        self.path = [spots.positions[spot_id, :]]
-        self.intensity = [spots.spot_intensity[spot_id]]
-        self.bg_intensity = [spots.bg_intensity[spot_id]]
-        self.snr = [spots.snr[spot_id]]
-        self.length = 1
-        self.stoichiometry = 0
-        self.converged = [spots.converged[spot_id]]
-        self.linked_traj = None
-        self.width = [spots.width[spot_id]]
+    """TRAJECTORY - View of a single trajectory in a TrajectoryData store
 
-    def extend(self, spots, spot_id):
-        if spots.frame > self.end_frame + 1:
-            sys.exit("ERROR: Cannot extend a spot over multiple frames")
+    Description:
+        The per-frame fields are slices of the columns of the store, so no data
+        is copied. Width is the width of the first spot of the trajectory.
+    """
 
-        self.end_frame = spots.frame
-        self.path.append(spots.positions[spot_id, :])
-        self.intensity.append(spots.spot_intensity[spot_id])
-        self.bg_intensity.append(spots.bg_intensity[spot_id])
-        self.converged.append(spots.converged[spot_id])
-        self.snr.append(spots.snr[spot_id])
+    __slots__ = ("_data", "_index", "stoichiometry", "linked_traj")
 
-        self.length += 1
-
-def build_trajectories(all_spots, params):
-    trajectories = []
-    traj_num = 0
-
-    # Create a trajectory for all spots in the first frame
-    for i in range(all_spots[0].num_spots):
-        trajectories.append(Trajectory(traj_num, all_spots[0], i))
-        traj_num += 1
-
-    # Construct trajectories for the rest of the frames
-    for frame in range(1, len(all_spots)):
-        assigned_spots = []
-        for spot in range(all_spots[frame].num_spots):
-            close_candidates = []
-            for candidate in trajectories:
-                if candidate.end_frame != frame - 1:
-                    continue
-                candidate_dist = np.linalg.norm(
-                    all_spots[frame].positions[spot, :] - candidate.path[-1]
-                )
-                if candidate_dist < params.max_displacement:
-                    close_candidates.append(candidate)
-
-            if len(close_candidates) == 0:
-                trajectories.append(Trajectory(traj_num, all_spots[frame], spot))
-                traj_num += 1
+    def __init__(self, data, index):
+        self._data = data
+        self._index = index
+        self.stoichiometry = 0
+        self.linked_traj = None
 
-            elif len(close_candidates) == 1:
+    @property
+    def _rows(self):
+        start = self._data.offsets[self._index]
+        return slice(start, start + self._data.lengths[self._index])
+
+    @property
+    def id(self):
+        return self._data.ids[self._index]
+
+    @property
+    def length(self):
+        return self._data.lengths[self._index]
+
+    @property
+    def start_frame(self):
+        return self._data.frame[self._data.offsets[self._index]]
+
+    @property
+    def end_frame(self):
+        return self._data.frame[self._rows][-1]
+
+    @property
+    def frames(self):
+        return self._data.frame[self._rows]
+
+    @property
+    def path(self):
+        return self._data.positions[self._rows]
+
+    @property
+    def intensity(self):
+        return self._data.intensity[self._rows]
+
+    @property
+    def bg_intensity(self):
+        return self._data.bg_intensity[self._rows]
+
+    @property
+    def snr(self):
+        return self._data.snr[self._rows]
+
+    @property
+    def converged(self):
+        return self._data.converged[self._rows]
+
+    @property
+    def width(self):
+        start = self._data.offsets[self._index]
+        return self._data.width[start : start + 1]
+
+    def frame_index(self, frame):
+        """Row of the trajectory in the given frame, or None if it has no spot there"""
+        frames = self.frames
+        if frames[-1] - frames[0] + 1 == len(frames):
+            # No gaps, so the row is just the offset from the first frame
+            row = frame - frames[0]
+        else:
+            row = np.searchsorted(frames, frame)
+        if 0 <= row < len(frames) and frames[row] == frame:
+            return row
+        return None
 
-                close_candidates[0].extend(all_spots[frame], spot)
 
+def _as_column(values, dtype=None, pair=False):
+    # Columns that were not loaded are kept as None
+    if values is None:
+        return None
+    column = np.asarray(values, dtype=dtype)
+    return column.reshape(-1, 2) if pair else column
+
+
+class TrajectoryData(Sequence):
+    """TRAJECTORYDATA - Columnar store of a set of trajectories
+
+    Description:
+        Holds one array per field for all the spots of all the trajectories,
+        with the spots of each trajectory stored contiguously and in frame
+        order. Trajectories are located in the columns through the offsets and
+        lengths arrays, and indexing or iterating gives Trajectory views.
+
+    Parameters:
+        traj_ids: The trajectory each row belongs to. Consecutive rows with the
+                  same id make up one trajectory.
+        frame, positions, intensity, bg_intensity, snr, converged, width:
+                  The per-spot columns. Any but frame may be None if it was
+                  not loaded.
+    """
+
+    columns = ("frame", "positions", "intensity", "bg_intensity", "snr", "converged", "width")
+
+    def __init__(self, traj_ids, frame, positions, intensity, bg_intensity, snr, converged, width):
+        traj_ids = np.asarray(traj_ids, dtype=int)
+        starts = np.flatnonzero(np.diff(traj_ids, prepend=traj_ids[:1] - 1))
+
+        self.ids = traj_ids[starts]
+        self.offsets = starts
+        self.lengths = np.diff(starts, append=len(traj_ids))
+        self.frame = np.asarray(frame, dtype=int)
+        self.positions = _as_column(positions, pair=True)
+        self.intensity = _as_column(intensity)
+        self.bg_intensity = _as_column(bg_intensity)
+        self.snr = _as_column(snr)
+        self.converged = _as_column(converged, dtype=np.int8)
+        self.width = _as_column(width, pair=True)
+        self._views = [Trajectory(self, i) for i in range(len(self.ids))]
+
+    def __len__(self):
+        return len(self._views)
+
+    def __getitem__(self, index):
+        return self._views[index]
+
+    @property
+    def spans(self):
+        """Number of frames from the first to the last spot of each trajectory"""
+        return self.frame[self.offsets + self.lengths - 1] - self.frame[self.offsets] + 1
+
+    def frame_rows(self, indices):
+        """Rows of the given trajectories, with the position in indices of the
+        trajectory each belongs to and its offset from that trajectory's first
+        frame"""
+        lengths = self.lengths[indices]
+        owner = np.repeat(np.arange(len(indices)), lengths)
+        rows = np.arange(np.sum(lengths)) + np.repeat(
+            self.offsets[indices] - np.cumsum(lengths) + lengths, lengths
+        )
+        frames = self.frame[rows] - self.frame[self.offsets[indices]][owner]
+        return rows, owner, frames
+
+    def frame_grid(self, column, indices):
+        """Values of a column for the given trajectories laid out by frame
+
+        Gives an array of shape (len(indices), max span, ...) whose [i, f]
+        entry is the value f frames after the first frame of trajectory
+        indices[i], or NaN if it has no spot in that frame (or ends before).
+        """
+        rows, owner, frames = self.frame_rows(indices)
+        grid = np.full(
+            (len(indices), self.spans[indices].max(initial=0)) + column.shape[1:], np.nan
+        )
+        grid[owner, frames] = column[rows]
+        return grid
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Join several stores into one, keeping the order of the trajectories"""
+        return cls(
+            np.concatenate([np.repeat(store.ids, store.lengths) for store in stores]),
+            *[
+                np.concatenate([getattr(store, column) for store in stores])
+                for column in cls.columns
+            ],
+        )
+
+
+class _Track:
+    # Linking state of a trajectory that is still being built, with a copy of
+    # the row of each of its spots
+    __slots__ = ("id", "end_frame", "position", "length", "rows")
+
+    def __init__(self, id, frame, position, row):
+        self.id = id
+        self.end_frame = frame
+        self.position = position
+        self.length = 1
+        self.rows = [row]
+
+
+class Linker:
+    """LINKER - Online linking of spots into trajectories
+
+    Description:
+        Linker links spots into trajectories one frame at a time, either
+        greedily or by solving a linear assignment problem (linking_method),
+        and can bridge up to max_gap_frames frames in which a trajectory's
+        spot was not detected. Each trajectory keeps its own spots, and is
+        handed back, as part of a TrajectoryData, as soon as it can no longer
+        be extended, so that it can be written out while later frames are
+        still being tracked. Finished trajectories shorter than min_traj_len
+        are dropped and the rest are numbered in the order they finish;
+        sort_by_creation renumbers a complete run in order of creation.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.frame = 0
+        self.traj_num = 0
+        self.next_id = 0
+        self.active = []
+        # Creation number of each trajectory handed back, in output order
+        self.created = []
+
+    def add_frame(self, spots):
+        frame = self.frame
+        max_gap = self.params.max_gap_frames
+        links = np.full(spots.num_spots, -1)
+
+        if spots.num_spots > 0:
+            rows = np.column_stack((
+                np.full(spots.num_spots, spots.frame), spots.positions,
+                spots.spot_intensity, spots.bg_intensity, spots.snr,
+                spots.converged[: spots.num_spots], spots.width,
+            )).tolist()
+
+        if frame > 0 and spots.num_spots > 0:
+            # Link spots to the trajectories that ended in the previous frame
+            candidates = [track for track in self.active if track.end_frame == frame - 1]
+            ends = np.array([track.position for track in candidates]).reshape(-1, 2)
+            if self.params.linking_method == "LAP":
+                links = link_spots(ends, spots.positions, self.params.max_displacement)
             else:
-                trajectories.append(Trajectory(traj_num, all_spots[frame], spot))
-                traj_num += 1
-
-    filtered_trajectories = list(filter(lambda x: x.length >= params.min_traj_len, trajectories))
-
-    actual_traj_num = 0
-    for traj in filtered_trajectories:
-        traj.id = actual_traj_num
-        actual_traj_num += 1
-
-    return filtered_trajectories
+                links = self._link_greedy(ends, spots.positions)
+            for spot in np.flatnonzero(links >= 0):
+                self._extend(candidates[links[spot]], spots, spot, rows[spot])
+
+            # Close gaps by linking what is left to trajectories that lost
+            # their spot for up to max_gap frames
+            unlinked = np.flatnonzero(links < 0)
+            gapped = [
+                track for track in self.active
+                if frame - 1 - max_gap <= track.end_frame < frame - 1
+            ]
+            if len(unlinked) > 0 and gapped:
+                ends = np.array([track.position for track in gapped])
+                gaps = frame - np.array([track.end_frame for track in gapped])
+                gap_links = link_spots(
+                    ends, spots.positions[unlinked], self.params.max_displacement, gaps
+                )
+                for spot in np.flatnonzero(gap_links >= 0):
+                    self._extend(gapped[gap_links[spot]], spots, unlinked[spot], rows[unlinked[spot]])
+                    links[unlinked[spot]] = gap_links[spot]
+
+        for spot in np.flatnonzero(links < 0):
+            self._new_trajectory(spots, spot, rows[spot])
+
+        # Anything that ended more than max_gap frames ago can no longer be extended
+        finished = [track for track in self.active if track.end_frame < frame - max_gap]
+        self.active = [track for track in self.active if track.end_frame >= frame - max_gap]
+        self.frame += 1
+
+        return self._collect(finished)
+
+    def _link_greedy(self, ends, positions):
+        # Each spot takes the one trajectory within range not already extended
+        # by an earlier spot, or starts a new one if there is any ambiguity
+        links = np.full(len(positions), -1)
+        if len(ends) == 0:
+            return links
+
+        neighbours = cKDTree(ends).query_ball_point(positions, self.params.max_displacement)
+        extended = np.zeros(len(ends), dtype=bool)
+        for spot in range(len(positions)):
+            close_candidates = [
+                candidate for candidate in neighbours[spot]
+                if not extended[candidate]
+                and np.linalg.norm(positions[spot, :] - ends[candidate])
+                < self.params.max_displacement
+            ]
+
+            if len(close_candidates) == 1:
+                links[spot] = close_candidates[0]
+                extended[close_candidates[0]] = True
+
+        return links
+
+    def finish(self):
+        finished = self.active
+        self.active = []
+        return self._collect(finished)
+
+    def sort_by_creation(self, trajs):
+        """Renumber everything this linker handed back in order of creation
+
+        This gives the numbering of linking all the frames at once, and takes
+        the concatenation of every batch returned by add_frame and finish.
+        """
+        rank = np.argsort(np.argsort(self.created))
+        traj_ids = rank[np.repeat(trajs.ids, trajs.lengths)]
+        order = np.argsort(traj_ids, kind="stable")
+        return TrajectoryData(
+            traj_ids[order],
+            *[getattr(trajs, column)[order] for column in TrajectoryData.columns],
+        )
+
+    def _new_trajectory(self, spots, spot_id, row):
+        track = _Track(self.traj_num, spots.frame, spots.positions[spot_id, :], row)
+        self.traj_num += 1
+        self.active.append(track)
+
+    def _extend(self, track, spots, spot_id, row):
+        track.end_frame = spots.frame
+        track.position = spots.positions[spot_id, :]
+        track.length += 1
+        track.rows.append(row)
+
+    def _collect(self, tracks):
+        # Gather the spots of the finished trajectories that are long enough
+        # into a store, numbering them in order of creation among themselves
+        tracks = sorted(
+            (track for track in tracks if track.length >= self.params.min_traj_len),
+            key=lambda track: track.id,
+        )
+        if not tracks:
+            return TrajectoryData([], [], [], [], [], [], [], [])
+
+        rows = np.array([row for track in tracks for row in track.rows])
+        traj_ids = np.repeat(
+            np.arange(self.next_id, self.next_id + len(tracks)),
+            [track.length for track in tracks],
+        )
+        self.next_id += len(tracks)
+        self.created.extend(track.id for track in tracks)
+
+        return TrajectoryData(
+            traj_ids, rows[:, 0], rows[:, 1:3], rows[:, 3], rows[:, 4],
+            rows[:, 5], rows[:, 6], rows[:, 7:9],
+        )
+
+
+def link_spots(ends, positions, max_displacement, gaps=None):
+    """LINK_SPOTS - Globally optimal one-to-one linking of spots to trajectory ends
+
+    Description:
+        Solves the linear assignment problem between the last positions of a
+        set of trajectories and the spots of a new frame, minimising the total
+        squared displacement. Only pairs closer than max_displacement (scaled
+        by the square root of the number of frames spanned when gaps are
+        given) are considered, and each trajectory or spot can instead be left
+        unlinked at a cost of max_displacement^2. The sparse set of allowed
+        links is split into connected components which are solved separately,
+        so the cost grows with the size of the clusters rather than with the
+        number of spots.
+
+    Returns:
+        links: For each spot, the index of the trajectory end it is linked to,
+               or -1 if it is not linked.
+    """
+    links = np.full(len(positions), -1)
+    if len(ends) == 0 or len(positions) == 0:
+        return links
+
+    if gaps is None:
+        gaps = np.ones(len(ends))
+    radii = max_displacement * np.sqrt(gaps)
+
+    # All the allowed (trajectory end, spot) pairs, with their costs
+    neighbours = cKDTree(positions).query_ball_point(ends, radii)
+    end_ids = np.repeat(np.arange(len(ends)), [len(n) for n in neighbours])
+    spot_ids = np.fromiter(chain.from_iterable(neighbours), dtype=int, count=len(end_ids))
+    sq_dist = np.sum((positions[spot_ids] - ends[end_ids]) ** 2, axis=1)
+    allowed = sq_dist < radii[end_ids] ** 2
+    end_ids, spot_ids = end_ids[allowed], spot_ids[allowed]
+    costs = sq_dist[allowed] / gaps[end_ids]
+    if len(costs) == 0:
+        return links
+
+    # Independent sub-problems are the connected components of the graph of
+    # allowed links, with the ends numbered before the spots
+    num_nodes = len(ends) + len(positions)
+    graph = coo_matrix(
+        (np.ones(len(costs)), (end_ids, len(ends) + spot_ids)), shape=(num_nodes, num_nodes)
+    )
+    _, labels = connected_components(graph, directed=False)
+    edge_labels = labels[end_ids]
+    edges_per_component = np.bincount(edge_labels)
+
+    # A lone allowed pair is always worth linking
+    lone = edges_per_component[edge_labels] == 1
+    links[spot_ids[lone]] = end_ids[lone]
+
+    no_link_cost = max_displacement**2
+    order = np.argsort(edge_labels[~lone], kind="stable")
+    component_edges = np.flatnonzero(~lone)[order]
+    boundaries = np.flatnonzero(np.diff(edge_labels[component_edges])) + 1
+    for edges in np.split(component_edges, boundaries):
+        if len(edges) == 0:
+            continue
+        comp_ends, end_idx = np.unique(end_ids[edges], return_inverse=True)
+        comp_spots, spot_idx = np.unique(spot_ids[edges], return_inverse=True)
+        n_ends, n_spots = len(comp_ends), len(comp_spots)
+
+        # Pad the cost matrix so that every end and spot can go unlinked:
+        #   [ links    | end dies  ]
+        #   [ spot new | (dummy)   ]
+        cost = np.full((n_ends + n_spots, n_spots + n_ends), np.inf)
+        cost[end_idx, spot_idx] = costs[edges]
+        cost[np.arange(n_ends), n_spots + np.arange(n_ends)] = no_link_cost
+        cost[n_ends + np.arange(n_spots), np.arange(n_spots)] = no_link_cost
+        cost[n_ends + spot_idx, n_spots + end_idx] = 0
+        rows, cols = linear_sum_assignment(cost)
+
+        linked = (rows < n_ends) & (cols < n_spots)
+        links[comp_spots[cols[linked]]] = comp_ends[rows[linked]]
+
+    return links
 
 
-def write_trajectories(trajectories, filename):
-    f = open(filename, "w")
-    f.write(f"trajectory\tframe\tx\ty\tspot_intensity\tbg_intensity\tSNR\tconverged\twidthx\twidthy\n")
-    for traj in trajectories:
-        for frame in range(traj.start_frame, traj.end_frame + 1):
-            i = frame - traj.start_frame
-            f.write(
-                f"{traj.id}\t{frame}\t{traj.path[i][0]}\t{traj.path[i][1]}\t{traj.intensity[i]}\t{traj.bg_intensity[i]}\t{traj.snr[i]}\t{traj.converged[i]}\t{traj.width[0][0]}\t{traj.width[0][1]}\n"
-            )
+def build_trajectories(all_spots, params):
+    linker = Linker(params)
+
+    trajectories = [linker.add_frame(spots) for spots in all_spots]
+    trajectories.append(linker.finish())
+
+    return linker.sort_by_creation(TrajectoryData.concatenate(trajectories))
+
+
+def trajectory_filename(stem, params):
+    """TRAJECTORY_FILENAME - File name for trajectories in the chosen trajectory_format"""
+    return stem + (".npz" if params.trajectory_format == "NPZ" else ".tsv")
+
+
+def write_trajectories(trajectories, filename, append=False):
+    if filename.endswith(".npz"):
+        if append:
+            sys.exit("ERROR: Cannot append to a binary trajectory file")
+        write_trajectories_npz(trajectories, filename)
+        return
+
+    if append:
+        f = open(filename, "a")
+    else:
+        f = open(filename, "w")
+        f.write(f"trajectory\tframe\tx\ty\tspot_intensity\tbg_intensity\tSNR\tconverged\twidthx\twidthy\n")
+
+    if len(trajectories) > 0:
+        # Format whole columns at once, every row carries the trajectory's
+        # first width
+        width = np.repeat(trajectories.width[trajectories.offsets], trajectories.lengths, axis=0)
+        columns = [
+            np.repeat(trajectories.ids, trajectories.lengths),
+            trajectories.frame,
+            trajectories.positions[:, 0],
+            trajectories.positions[:, 1],
+            trajectories.intensity,
+            trajectories.bg_intensity,
+            trajectories.snr,
+            trajectories.converged,
+            width[:, 0],
+            width[:, 1],
+        ]
+        # Converting to Python scalars formats each value exactly as str() would
+        text = [map(str, column.tolist()) for column in columns]
+        f.write("\n".join(map("\t".join, zip(*text))) + "\n")
     f.close()
 
 
 def to_spots(trajs):
+    # Group the rows of all the trajectories by frame with a single stable
+    # sort, keeping the trajectories in order within each frame
+    frame = trajs.frame
+    num_frames = frame.max() + 1 if len(frame) > 0 else 1
+    order = np.argsort(frame, kind="stable")
+    bounds = np.searchsorted(frame[order], np.arange(num_frames + 1))
+    width = np.repeat(trajs.width[trajs.offsets], trajs.lengths, axis=0)
+
     all_spots = []
-    frame = 0
-    done_all_frames = False
-    while not done_all_frames:
-        done_all_frames = True
-
-        # Get the spots from trajs for this frame
-        positions = []
-        bg_intensity = []
-        spot_intensity = []
-        snr = []
-        converged = []
-        width = []
-        for traj in trajs:
-
-            if traj.end_frame > frame:
-                done_all_frames = False
-
-            if traj.start_frame > frame or traj.end_frame < frame:
-                continue
-
-            i = frame-traj.start_frame
-            positions.append(traj.path[i][:])
-            spot_intensity.append(traj.intensity[i])
-            bg_intensity.append(traj.bg_intensity[i])
-            snr.append(traj.snr[i])
-            converged.append(traj.converged[i])
-            width.append(traj.width)
-
-
-        spots = Spots(len(positions), frame)
-        spots.set_positions(np.array(positions))
-        spots.spot_intensity = np.array(spot_intensity)
-        spots.bg_intensity = np.array(bg_intensity)
-        spots.snr = np.array(snr)
-        spots.converged = np.array(converged, dtype=np.int8)
-        spots.width=np.array(width)
+    for frame in range(num_frames):
+        rows = order[bounds[frame] : bounds[frame + 1]]
+        spots = Spots(len(rows), frame)
+        spots.set_positions(trajs.positions[rows])
+        spots.spot_intensity = trajs.intensity[rows]
+        spots.bg_intensity = trajs.bg_intensity[rows]
+        spots.snr = trajs.snr[rows]
+        spots.converged = trajs.converged[rows]
+        spots.width = width[rows]
         all_spots.append(spots)
 
-        frame += 1
-
     return all_spots
 
-def read_trajectories(filename):
-    trajectories = []
-    prev_traj_id = -1
+def write_trajectories_npz(trajectories, filename):
+    """WRITE_TRAJECTORIES_NPZ - Write trajectories as binary columns
+
+    Description:
+        Saves the columns of a TrajectoryData to a compressed NPZ file, along
+        with an index of the rows in each frame: the rows of frame f are
+        frame_order[frame_offsets[f - first_frame] : frame_offsets[f - first_frame + 1]].
+    """
+    if len(trajectories) == 0:
+        trajectories = TrajectoryData([], [], [], [], [], [], [], [])
+
+    frame = trajectories.frame
+    first_frame = frame.min() if len(frame) > 0 else 0
+    frame_order = np.argsort(frame, kind="stable")
+    frame_offsets = np.concatenate([[0], np.cumsum(np.bincount(frame - first_frame))])
+
+    np.savez_compressed(
+        filename,
+        trajectory=np.repeat(trajectories.ids, trajectories.lengths),
+        frame_order=frame_order,
+        frame_offsets=frame_offsets,
+        first_frame=first_frame,
+        **{column: getattr(trajectories, column) for column in TrajectoryData.columns},
+    )
+
+
+# Columns of the TSV file holding each field
+_tsv_columns = {
+    "trajectory": [0],
+    "frame": [1],
+    "positions": [2, 3],
+    "intensity": [4],
+    "bg_intensity": [5],
+    "snr": [6],
+    "converged": [7],
+    "width": [8, 9],
+}
+
+
+def read_trajectories(filename, columns=None, frames=None):
+    """READ_TRAJECTORIES - Read trajectories from a TSV or NPZ file
+
+    Parameters:
+        columns: The TrajectoryData columns to load, all of them if None. The
+                 rest are left as None.
+        frames:  A (start, stop) range of frames to load, all of them if None.
+                 Trajectories are cut down to the rows inside the range.
+    """
     if not os.path.isfile(filename):
         print(f"WARNING: No such file {filename}")
         return None
-    with open(filename) as tsv_file:
-        tsv_reader = csv.reader(tsv_file,delimiter="\t")
-        for line in tsv_reader:
-            if line[0] == "trajectory":
-                continue
-            spot = Spots(num_spots=1)
-            traj_id = int(line[0])
-            spot.frame = int(line[1])
-            spot.positions[0, :] = [float(line[2]), float(line[3])]
-            spot.spot_intensity[0] = float(line[4])
-            spot.bg_intensity[0] = float(line[5])
-            spot.snr[0] = float(line[6])
-            spot.converged[0] = int(line[7])
-            spot.width[0,:] = [float(line[8]),float(line[9])]
-
-            if traj_id != prev_traj_id:
-                trajectories.append(Trajectory(traj_id, spot, 0))
+    if columns is None:
+        columns = TrajectoryData.columns
+    fields = ["trajectory", "frame"] + [column for column in columns if column != "frame"]
+
+    if filename.endswith(".npz"):
+        with np.load(filename) as npz:
+            if frames is None:
+                rows = slice(None)
             else:
-                trajectories[-1].extend(spot, 0)
-            prev_traj_id = traj_id
-
-    return trajectories
+                # Look the rows up in the frame index
+                offsets = npz["frame_offsets"]
+                first, last = np.clip(np.array(frames) - npz["first_frame"], 0, len(offsets) - 1)
+                rows = np.sort(npz["frame_order"][offsets[first] : offsets[last]])
+            data = {field: npz[field][rows] for field in fields}
+
+    else:
+        usecols = [i for field in fields for i in _tsv_columns[field]]
+        with warnings.catch_warnings():
+            # A file holding just the header has no rows to read
+            warnings.simplefilter("ignore", UserWarning)
+            table = np.loadtxt(
+                filename, delimiter="\t", skiprows=1, usecols=usecols, ndmin=2
+            ).reshape(-1, len(usecols))
+
+        data = {}
+        start = 0
+        for field in fields:
+            width = len(_tsv_columns[field])
+            data[field] = table[:, start] if width == 1 else table[:, start : start + width]
+            start += width
+        if frames is not None:
+            rows = (data["frame"] >= frames[0]) & (data["frame"] < frames[1])
+            data = {field: values[rows] for field, values in data.items()}
+
+    return TrajectoryData(
+        data["trajectory"].astype(int),
+        *[data.get(column) for column in TrajectoryData.columns],
+    )
 
 def compare_trajectories(params):
-    all_target_spots = []
-    all_spots = []
-
-    trajs = read_trajectories(params.name + "_trajectories.tsv")
-    target_trajs = read_trajectories(params.name + "_simulated.tsv")
-
-    frame = 0
-    done_all_frames = False
-    while not done_all_frames:
-        done_all_frames = True
-
-        # Get the spots from target_trajs for this frame
-        frame_target_spots = []
-        for traj in target_trajs:
-
-            if traj.end_frame > frame:
-                done_all_frames = False
-
-            if traj.start_frame > frame or traj.end_frame < frame:
-                continue
-            frame_target_spots.append(traj.path[frame-traj.start_frame][:])
-
-        target_spots = Spots(len(frame_target_spots), frame)
-        target_spots.set_positions(np.array(frame_target_spots))
-        all_target_spots.append(target_spots)
-
-        # Get the spots from trajs for this frame
-        frame_spots = []
-        for traj in trajs:
-
-            if traj.end_frame > frame:
-                done_all_frames = False
-
-            if traj.start_frame > frame or traj.end_frame < frame:
-                continue
-
-            frame_spots.append(traj.path[frame-traj.start_frame][:])
-
-        spots = Spots(len(frame_spots), frame)
-        spots.set_positions(np.array(frame_spots))
-        all_spots.append(spots)
-
-        frame += 1
-
-    num_frames = frame
+    """COMPARE_TRAJECTORIES - Score tracked spots against the simulated ground truth
+
+    Description:
+        Matches the tracked spots to the simulated ones one-to-one within each
+        frame, minimising the total squared distance between matched pairs,
+        which must be less than 1 pixel apart. Simulated spots outside the
+        frame are not counted. The per-frame and overall match counts,
+        precision, recall, Jaccard index and RMS error are printed and written
+        to NAME_comparison.tsv.
+    """
+    trajs = read_trajectories(
+        trajectory_filename(params.name + "_trajectories", params), columns=["positions"]
+    )
+    target_trajs = read_trajectories(params.name + "_simulated.tsv", columns=["positions"])
+
+    found, found_frame = trajs.positions, trajs.frame
+    inside = np.all(
+        (target_trajs.positions >= 0) & (target_trajs.positions < np.array(params.frame_size)), axis=1
+    )
+    target, target_frame = target_trajs.positions[inside], target_trajs.frame[inside]
+    num_frames = max(found_frame.max(initial=0), target_trajs.frame.max(initial=0)) + 1
+
+    # Match every frame in a single assignment problem by spacing the frames
+    # out far enough along x that spots in different frames are never in range
+    spacing = 2 * max(np.abs(found).max(initial=0), np.abs(target).max(initial=0)) + 2
+    links = link_spots(
+        target + np.column_stack([target_frame * spacing, np.zeros(len(target))]),
+        found + np.column_stack([found_frame * spacing, np.zeros(len(found))]),
+        1.0,
+    )
+    matched = links >= 0
+    errors = np.linalg.norm(found[matched] - target[links[matched]], axis=1)
+    match_frame = found_frame[matched]
+
+    counts = {
+        "found": np.bincount(found_frame, minlength=num_frames),
+        "targets": np.bincount(target_frame, minlength=num_frames),
+        "outside": np.bincount(target_trajs.frame[~inside], minlength=num_frames),
+        "matches": np.bincount(match_frame, minlength=num_frames),
+        "error": np.bincount(match_frame, weights=errors, minlength=num_frames),
+        "sq_error": np.bincount(match_frame, weights=errors**2, minlength=num_frames),
+    }
+    # The last entry of each count is the total over all frames
+    counts = {name: np.append(count, count.sum()) for name, count in counts.items()}
+    matches = counts["matches"]
+    false_negatives = counts["targets"] - matches
+    false_positives = counts["found"] - matches
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_error = counts["error"] / matches
+        rmse = np.sqrt(counts["sq_error"] / matches)
+        precision = matches / counts["found"]
+        recall = matches / counts["targets"]
+        jaccard = matches / (matches + false_negatives + false_positives)
 
     for frame in range(num_frames):
-        false_positives = 0
-        false_negatives = 0
-        multiples = 0
-        matches = 0
-        errors = []
-        outside_frame = 0
-
-        assigned_spots = []
-        for spot in range(all_target_spots[frame].num_spots):
-
-            if all_target_spots[frame].positions[spot,0] < 0 \
-                      or all_target_spots[frame].positions[spot,1] < 0 \
-                      or all_target_spots[frame].positions[spot,0] >= params.frame_size[0] \
-                      or all_target_spots[frame].positions[spot,1] >= params.frame_size[1]:
-              outside_frame  += 1
-              continue
-
-            close_candidates = []
-            for candidate in range(all_spots[frame].num_spots):
-                candidate_dist = np.linalg.norm(
-                    all_target_spots[frame].positions[spot,:] - all_spots[frame].positions[candidate,:]
-                )
-                if candidate_dist < 1:
-                    close_candidates.append(candidate_dist)
-
-            if len(close_candidates) == 0:
-                false_negatives += 1
-
-            elif len(close_candidates) == 1:
-                matches += 1
-                errors.append(close_candidates[0])
-
-            else:
-                false_negatives += 1
-                multiples += 1
-
-        false_positives = all_spots[frame].num_spots - matches
         print(f"Frame {frame:4d}:",
-              f"Error = {np.mean(np.array(errors)):8f} pixels, ",
-              f"Found = {all_spots[frame].num_spots:3d} ",
-              f"Matches = {matches:3d} ",
-              f"False negatives = {false_negatives:3d} ",
-              f"False positives = {false_positives:3d} ",
-              f"Outside = {outside_frame:3d} ")
+              f"Error = {mean_error[frame]:8f} pixels, ",
+              f"Found = {counts['found'][frame]:3d} ",
+              f"Matches = {matches[frame]:3d} ",
+              f"False negatives = {false_negatives[frame]:3d} ",
+              f"False positives = {false_positives[frame]:3d} ",
+              f"Outside = {counts['outside'][frame]:3d} ")
+    print(f"Total:      RMS error = {rmse[-1]:8f} pixels, ",
+          f"Precision = {precision[-1]:.4f} ",
+          f"Recall = {recall[-1]:.4f} ",
+          f"Jaccard = {jaccard[-1]:.4f}")
+
+    f = open(params.name + "_comparison.tsv", "w")
+    f.write("frame\tfound\ttargets\toutside\tmatches\tfalse_negatives\tfalse_positives\tprecision\trecall\tjaccard\trmse\n")
+    for frame in range(num_frames + 1):
+        label = frame if frame < num_frames else "all"
+        f.write(
+            f"{label}\t{counts['found'][frame]}\t{counts['targets'][frame]}\t{counts['outside'][frame]}\t{matches[frame]}\t{false_negatives[frame]}\t{false_positives[frame]}\t{precision[frame]}\t{recall[frame]}\t{jaccard[frame]}\t{rmse[frame]}\n"
+        )
+    f.close()
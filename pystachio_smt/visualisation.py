@@ -20,7 +20,9 @@ import trajectories
 def render(params):
     image_data = images.ImageData()
     image_data.read(params.name+".tif", params)
-    trajs = trajectories.read_trajectories(params.name + "_trajectories.tsv")
+    trajs = trajectories.read_trajectories(
+        trajectories.trajectory_filename(params.name + "_trajectories", params)
+    )
     true_trajs = trajectories.read_trajectories(params.name + "_simulated.tsv")
 
     maxval = image_data.max_intensity()
@@ -38,9 +40,9 @@ def render(params):
         for traj in trajs:
             x = []
             y = []
-            for frame in range(traj.start_frame, traj.end_frame):
-                x.append(traj.path[frame - traj.start_frame][0])
-                y.append(traj.path[frame - traj.start_frame][1])
+            for position in traj.path:
+                x.append(position[0])
+                y.append(position[1])
 
             x = np.array(x)
             y = np.array(y)
@@ -54,9 +56,9 @@ def render(params):
         for traj in true_trajs:
             x = []
             y = []
-            for frame in range(traj.start_frame, traj.end_frame):
-                x.append(traj.path[frame - traj.start_frame][0])
-                y.append(traj.path[frame - traj.start_frame][1])
+            for position in traj.path:
+                x.append(position[0])
+                y.append(position[1])
 
             x = np.array(x)
             y = np.array(y)